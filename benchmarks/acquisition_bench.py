@@ -0,0 +1,410 @@
+#!/usr/bin/env python
+#     DStat Interface - An interface for the open hardware DStat potentiostat
+#     Copyright (C) 2014  Michael D. M. Dryden -
+#     Wheeler Microfluidics Laboratory <http://microfluidics.utoronto.ca>
+#
+#
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Measures the acquisition pipeline: emulator.VirtualDStat -> _serial_process
+-> Experiment.serial_handler -> data_pipe (or sample ring) -> a headless
+consumer doing what Main.experiment_running_data does.
+
+Each experiment type is run at each ADC rate in fresh processes. For each
+run the end-to-end sample rate, latency percentiles of each pipeline stage,
+CPU time and peak memory of the device, serial and consumer processes are
+recorded. Stages are measured per data_pipe message using the timestamps
+added by Experiment.profile:
+    decode -- serial read returned until samples were decoded and queued
+    queue -- queued until sent (chunking in Experiment.flush_batch)
+    pipe -- sent until received by consumer
+    ingest -- received until stored (in bulk, once per wakeup)
+    total -- serial read returned until stored
+The time from sending the experiment until the serial read returning its
+first sample is reported as start-up; compare runs with and without
+--pipelined (commands sent in one write) to see the handshakes saved.
+Runs can be recorded with --capture and later replayed through the same
+pipeline with --replay instead of the emulator (see serial_capture).
+--smoke first runs the experiments that don't produce a data stream (offset
+calibration and OCP) once each and exits with status 1 if either fails.
+Linux only (uses /proc).
+
+Usage: python acquisition_bench.py [-e lsv,cv,...] [-r 100,1000,...]
+           [-d seconds] [--fast] [--ring] [--pipelined]
+           [--capture DIR | --replay DIR] [--smoke] [-o results.json]
+"""
+
+import sys, os, time, json, platform, subprocess, argparse
+import multiprocessing as mp
+import numpy as np
+
+sys.path.insert(0, os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        'dstat_interface'))
+
+import dstat_comm as comm
+import emulator
+
+RATE_CODES = dict((v, k) for k, v in emulator.ADC_RATES.items())
+STAGES = ('decode', 'queue', 'pipe', 'ingest', 'total')
+PERCENTILES = (50, 90, 99)
+INGEST_BUDGET = .02  # as Main.ingest_budget
+
+def _base_parameters(rate):
+    return {'version' : (1, 2), 'gain' : '2', 're_short' : '0',
+            'adc_buffer' : '2', 'adc_rate' : RATE_CODES[rate],
+            'adc_pga' : '2', 'clean_s' : 0, 'dep_s' : 0, 'clean_mV' : 0,
+            'dep_mV' : 0}
+
+def make_experiment(name, rate, duration):
+    """Returns Experiment instance of type name taking about duration
+    seconds at rate samples/s. Voltammetry scan rates are chosen so the
+    emulator produces rate samples/s; the potential window is limited to
+    the DStat's range, which shortens fast runs.
+    """
+    parameters = _base_parameters(rate)
+    window = 2800  # mV
+    # emulator sweeps in DAC steps, pulse methods in 1 mV steps
+    slope = max(int(round(rate*emulator.DAC_MV)), 1)
+    sweep = min(duration*slope, window)
+
+    if name == 'lsv':
+        parameters.update(start=-sweep//2, stop=sweep//2, slope=slope)
+        return comm.LSVExp(parameters)
+    elif name == 'cv':
+        parameters.update(v1=sweep//4, v2=-sweep//4, start=0, scans=1,
+                          slope=slope)
+        return comm.CVExp(parameters)
+    elif name == 'swv':
+        steps = min(int(duration*rate), window)
+        parameters.update(start=-steps//2, stop=steps//2, step=1, pulse=25,
+                          freq=int(rate), scans=0)
+        return comm.SWVExp(parameters)
+    elif name == 'dpv':
+        steps = min(int(duration*rate), window)
+        period = max(int(round(1000./rate)), 1)
+        parameters.update(start=-steps//2, stop=steps//2, step=1, pulse=25,
+                          period=period, width=max(period//2, 1))
+        return comm.DPVExp(parameters)
+    elif name == 'ca':
+        parameters.update(potential=[100], time=[int(duration)])
+        return comm.Chronoamp(parameters)
+    elif name == 'pd':
+        parameters.update(voltage=100, time=int(duration), interlock=False)
+        return comm.PDExp(parameters)
+    elif name == 'pot':
+        parameters.update(time=int(duration))
+        return comm.PotExp(parameters)
+    raise ValueError("Unknown experiment %s" % name)
+
+EXPERIMENTS = ('lsv', 'cv', 'swv', 'dpv', 'ca', 'pd', 'pot')
+
+class ProcessStats(object):
+    """CPU time and peak resident memory of a process from /proc."""
+    def __init__(self, pid):
+        self.pid = pid
+        self.start = self.cpu()
+
+    def cpu(self):
+        """Returns user + system CPU seconds used so far."""
+        with open("/proc/%i/stat" % self.pid) as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        return (int(fields[11]) + int(fields[12]))/float(
+                                        os.sysconf('SC_CLK_TCK'))
+
+    def peak_rss(self):
+        """Returns peak resident set size in kB."""
+        with open("/proc/%i/status" % self.pid) as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+
+    def result(self, wall):
+        cpu = self.cpu() - self.start
+        return {'cpu_s' : cpu, 'cpu_percent' : 100*cpu/wall,
+                'peak_rss_kb' : self.peak_rss()}
+
+def percentiles(values):
+    """Returns dict of PERCENTILES and max of values in ms."""
+    if not len(values):
+        return None
+    values = np.asarray(values)*1000
+    result = dict(("p%i" % p, float(np.percentile(values, p)))
+                  for p in PERCENTILES)
+    result['max'] = float(values.max())
+    return result
+
+def consume(serial_instance, task, budget=INGEST_BUDGET):
+    """Runs task and collects its data like Main.experiment_running_data
+    and Main.add_chunks: each wakeup drains the data pipe for up to budget
+    seconds, then adds the data to task.store in bulk. Returns (status,
+    samples, wakeups, latencies, first, end) where latencies is a dict of
+    lists for STAGES, first is when the serial read returning the first
+    sample finished and end is when the last sample was stored.
+    """
+    samples = 0
+    wakeups = 0
+    first = None
+    latencies = dict((i, []) for i in STAGES)
+    end = time.time()
+    status = None
+
+    while True:
+        if serial_instance.data_pipe_p.poll(.05):
+            start = time.time()
+            chunks = []
+            messages = []
+            while True:
+                incoming = serial_instance.data_pipe_p.recv()
+                if serial_instance.ring is None:
+                    scan, columns, stamps = incoming
+                    chunks.append((scan, columns))
+                else:
+                    stamps = incoming
+                    chunks += serial_instance.ring.read_chunks()
+                messages.append((stamps, time.time()))
+                if (not serial_instance.data_pipe_p.poll() or
+                        time.time() - start >= budget):
+                    break
+
+            task.store.reserve(sum(i[1].shape[1] for i in chunks))
+            for line, columns in chunks:
+                task.store.append(line, columns)
+                samples += columns.shape[1]
+
+            end = time.time()
+            wakeups += 1
+            for (read, decoded, sent), received in messages:
+                latencies['decode'].append(decoded - read)
+                latencies['queue'].append(sent - decoded)
+                latencies['pipe'].append(received - sent)
+                latencies['ingest'].append(end - received)
+                latencies['total'].append(end - read)
+
+            if first is None:
+                first = messages[0][0][0]
+
+        elif status is not None:
+            return status, samples, wakeups, latencies, first, end
+        elif serial_instance.proc_pipe_p.poll():
+            status = serial_instance.proc_pipe_p.recv()
+
+def capture_path(directory, name, rate):
+    return os.path.join(directory, "%s_%g.dcap" % (name, rate))
+
+def run_case(name, rate, options):
+    """Runs one experiment in a new serial process, against a new emulator
+    or replaying a capture made with --capture. options are the parsed
+    command line arguments. Returns dict of results.
+    """
+    device = None
+    connection = {'pacing' : 'none', 'ring' : options.ring}
+    if options.replay:
+        connection['replay'] = capture_path(options.replay, name, rate)
+        connection['replay_speed'] = options.replay_speed or None
+    else:
+        device = emulator.VirtualDStat(model=emulator.RandlesSevcik(),
+                                       noise=2, realtime=not options.fast,
+                                       seed=0)
+        device.start()
+        if options.capture:
+            connection['capture'] = capture_path(options.capture, name, rate)
+
+    try:
+        comm.version_check(None if device is None else device.port,
+                           **connection)
+        comm.read_settings()
+        serial_instance = comm.serial_instance
+
+        task = make_experiment(name, rate, options.duration)
+        task.profile = True
+        task.pipelined = options.pipelined
+        if options.chunk_size is not None:
+            task.chunk_size = options.chunk_size
+        if options.chunk_latency is not None:
+            task.chunk_latency = options.chunk_latency
+
+        processes = {'serial' : ProcessStats(serial_instance.proc.pid),
+                     'consumer' : ProcessStats(os.getpid())}
+        if device is not None:
+            processes['device'] = ProcessStats(device.process.pid)
+        start = time.time()
+        serial_instance.send_task(task)
+        status, samples, wakeups, latencies, first, end = consume(
+                                                    serial_instance, task)
+        wall = max(end - start, 1e-9)
+
+        result = {'experiment' : name, 'adc_rate' : rate,
+                  'status' : status, 'samples' : samples,
+                  'seconds' : wall, 'samples_per_s' : samples/wall,
+                  'messages' : len(latencies['total']),
+                  'wakeups' : wakeups,
+                  'startup_ms' : None if first is None
+                                 else (first - start)*1000,
+                  'latency_ms' : dict((i, percentiles(latencies[i]))
+                                      for i in STAGES),
+                  'processes' : dict((i, processes[i].result(wall))
+                                     for i in processes)}
+        if serial_instance.ring is not None:
+            result['ring'] = serial_instance.ring.stats()
+
+        serial_instance.ctrl_pipe_p.send("DISCONNECT")
+        serial_instance.proc.join(5)
+        return result
+    finally:
+        if device is not None:
+            device.stop()
+
+def smoke(options, timeout=10):
+    """Runs CALExp and OCPExp through Experiment.run against a new
+    emulator, as comm.measure_offset and Main.start_ocp do. Returns dict of
+    results with 'status' "DONE" or "ABORT" for a working experiment, or
+    "TIMEOUT" if the serial process didn't answer within timeout seconds.
+    """
+    device = emulator.VirtualDStat(model=emulator.RandlesSevcik(), noise=2,
+                                   realtime=not options.fast, seed=0)
+    device.start()
+    results = {}
+    try:
+        comm.version_check(device.port, pacing='none')
+        comm.read_settings()
+        serial_instance = comm.serial_instance
+
+        def status():
+            if serial_instance.proc_pipe_p.poll(timeout):
+                return serial_instance.proc_pipe_p.recv()
+            return "TIMEOUT"
+
+        serial_instance.send_task(comm.CALExp({'gain' : 2, 'time' : 1}))
+        results['cal'] = {'status' : status()}
+        if serial_instance.data_pipe_p.poll(1):
+            results['cal']['offset'] = serial_instance.data_pipe_p.recv()
+
+        task = comm.OCPExp()
+        task.pipelined = options.pipelined
+        serial_instance.send_task(task)
+        values = []
+        if serial_instance.data_pipe_p.poll(timeout):  # runs until aborted
+            values.append(serial_instance.data_pipe_p.recv())
+        serial_instance.ctrl_pipe_p.send('a')
+        results['ocp'] = {'status' : status()}
+        while serial_instance.data_pipe_p.poll(.1):
+            values.append(serial_instance.data_pipe_p.recv())
+        results['ocp']['samples'] = len(values)
+
+        serial_instance.ctrl_pipe_p.send("DISCONNECT")
+        serial_instance.proc.join(5)
+        return results
+    finally:
+        device.stop()
+
+def _run_case_child(queue, args):
+    try:
+        queue.put(run_case(*args))
+    except Exception as err:
+        queue.put({'experiment' : args[0], 'adc_rate' : args[1],
+                   'status' : "ERROR", 'error' : repr(err)})
+
+def run_isolated(*args):
+    """Runs run_case in a new process so peak memory is per run."""
+    queue = mp.Queue()
+    process = mp.Process(target=_run_case_child, args=(queue, args))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+def _git_version():
+    try:
+        return subprocess.check_output(
+                ['git', 'describe', '--always', '--dirty'],
+                cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0],
+                                     formatter_class=
+                                        argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-e', '--experiments', default=",".join(EXPERIMENTS),
+                        help="comma separated, from %s" %
+                             ",".join(EXPERIMENTS))
+    parser.add_argument('-r', '--rates', default="100,1000,7500,30000",
+                        help="comma separated ADC rates in Hz, from %s" %
+                             ",".join("%g" % i for i in sorted(RATE_CODES)))
+    parser.add_argument('-d', '--duration', type=int, default=2,
+                        help="seconds per run")
+    parser.add_argument('--fast', action='store_true',
+                        help="emulator sends as fast as possible")
+    parser.add_argument('--ring', action='store_true',
+                        help="pass samples through shared memory ring")
+    parser.add_argument('--pipelined', action='store_true',
+                        help="send experiment commands in one write")
+    parser.add_argument('--chunk-size', type=int, default=None)
+    parser.add_argument('--chunk-latency', type=float, default=None)
+    parser.add_argument('--capture', metavar='DIR', default=None,
+                        help="record serial traffic of each run to DIR")
+    parser.add_argument('--replay', metavar='DIR', default=None,
+                        help="replay captures from DIR instead of emulator")
+    parser.add_argument('--replay-speed', type=float, default=0,
+                        help="replay speed factor, 0 for as fast as possible")
+    parser.add_argument('--smoke', action='store_true',
+                        help="only run offset calibration and OCP once")
+    parser.add_argument('-o', '--output', default="acquisition_bench.json")
+    args = parser.parse_args()
+    if args.capture and not os.path.isdir(args.capture):
+        os.makedirs(args.capture)
+
+    rates = [float(i) for i in args.rates.split(',')]
+    for rate in rates:
+        if rate not in RATE_CODES:
+            parser.error("No ADC rate %g Hz" % rate)
+
+    if args.smoke:
+        failed = False
+        for name, result in sorted(smoke(args).items()):
+            print "%-4s %s" % (name, " ".join("%s=%s" % i
+                                              for i in sorted(result.items())))
+            failed |= result['status'] not in ("DONE", "ABORT") or \
+                      len(result) < 2
+        sys.exit(failed)
+
+    results = []
+    for name in args.experiments.split(','):
+        for rate in rates:
+            result = run_isolated(name, rate, args)
+            results.append(result)
+            if result['status'] == "ERROR":
+                print "%-4s %6g Hz  %s" % (name, rate, result['error'])
+                continue
+            total = result['latency_ms']['total'] or {}
+            print ("%-4s %6g Hz %8i samples %10.0f samples/s  "
+                   "start-up %7.2f ms  "
+                   "total p50 %7.2f ms p99 %7.2f ms  serial CPU %5.1f%%" % (
+                   name, rate, result['samples'], result['samples_per_s'],
+                   result['startup_ms'] or 0,
+                   total.get('p50', 0), total.get('p99', 0),
+                   result['processes']['serial']['cpu_percent']))
+
+    report = {'version' : _git_version(),
+              'time' : time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+              'python' : platform.python_version(),
+              'platform' : platform.platform(),
+              'numpy' : np.__version__,
+              'settings' : vars(args),
+              'results' : results}
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    print "Results written to %s" % args.output
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+#     DStat Interface - An interface for the open hardware DStat potentiostat
+#     Copyright (C) 2014  Michael D. M. Dryden -
+#     Wheeler Microfluidics Laboratory <http://microfluidics.utoronto.ca>
+#
+#
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Compares the throughput of the vectorized save.text exporter with the
+per-value loop it replaced, on synthetic SWV-like data (x, y, forward,
+reverse). Checks that both give the same file for x and y.
+
+Usage: python export_bench.py [samples] [scans]
+"""
+
+import sys, os, time, shutil, tempfile
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        'dstat_interface'))
+
+import numpy as np
+import storage
+import interface.save as save
+
+class BenchExperiment(object):
+    """Stands in for a finished dstat_comm.SWVExp."""
+    commands = ["EA2 3 1 ", "ES0 100 500 1 50 25 "]
+
+    def __init__(self, samples, scans, extra=True):
+        channels = ('x', 'y', 'forward', 'reverse')
+        self.store = storage.DataStore(channels if extra else channels[:2])
+        rng = np.random.RandomState(0)
+        for scan in range(scans):
+            x = np.linspace(-500., 500., samples // scans)
+            forward = rng.standard_normal(len(x))*1e-7
+            reverse = rng.standard_normal(len(x))*1e-7
+            self.store.append(scan, np.vstack((x, forward - reverse,
+                                               forward, reverse)))
+        self.data = self.store.view(('x', 'y'))
+        self.data_extra = self.store.view(('forward', 'reverse')) \
+                          if extra else []
+
+def legacy_text(exp, path):
+    """save.text before vectorization."""
+    file = open(path, 'w')
+
+    time = datetime.now()
+
+    header = "".join(['#', time.isoformat(), "\n#"])
+    for i in exp.commands:
+        header += i
+
+    file.write("".join([header, '\n']))
+    for col in zip(*[i.tolist() for i in exp.data]):
+        for row in col:
+            file.write(str(row)+ "    ")
+        file.write('\n')
+
+    file.close()
+
+def timed(function, *args, **kwargs):
+    start = time.time()
+    function(*args, **kwargs)
+    return time.time() - start
+
+def body(path):
+    """Returns file contents after the timestamp line."""
+    with open(path) as f:
+        f.readline()
+        return f.read()
+
+def report(name, values, path, elapsed):
+    size = os.path.getsize(path)
+    print "%-16s %9i values %8.1f MB %7.2f s %11.0f values/s %6.1f MB/s" % (
+        name, values, size/1e6, elapsed, values/elapsed, size/1e6/elapsed)
+
+if __name__ == "__main__":
+    samples = 1000000
+    scans = 2
+    if len(sys.argv) > 1:
+        samples = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        scans = int(sys.argv[2])
+
+    directory = tempfile.mkdtemp(prefix="dstat-export-")
+    try:
+        exp = BenchExperiment(samples, scans)
+        plain = BenchExperiment(samples, scans, extra=False)
+        values = len(exp.store)*2  # x and y
+
+        legacy_path = os.path.join(directory, "legacy.txt")
+        elapsed = timed(legacy_text, plain, legacy_path)
+        report("legacy", values, legacy_path, elapsed)
+        legacy = elapsed
+
+        path = os.path.join(directory, "text.txt")
+        elapsed = timed(save.text, plain, path)
+        report("text", values, path, elapsed)
+        print "identical output: %s, speedup: %.1fx" % (
+            body(path) == body(legacy_path), legacy/elapsed)
+
+        for name, float_format in (("text+extra", "%s"),
+                                   ("text+extra %.6e", "%.6e")):
+            path = os.path.join(directory, "extra.txt")
+            elapsed = timed(save.text, exp, path, float_format=float_format)
+            report(name, values*2, path, elapsed)
+    finally:
+        shutil.rmtree(directory)
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+#     DStat Interface - An interface for the open hardware DStat potentiostat
+#     Copyright (C) 2014  Michael D. M. Dryden -
+#     Wheeler Microfluidics Laboratory <http://microfluidics.utoronto.ca>
+#
+#
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Compares the throughput of stream_parser.FrameParser with the line
+iterating loop previously used in Experiment.serial_handler. A synthetic
+DStat stream is written to a pseudo-terminal by a child process and read
+back through pyserial. POSIX only.
+
+Usage: python parser_bench.py [samples] [databytes]
+"""
+
+import sys, os, pty, tty, time, struct, random
+import multiprocessing as mp
+
+sys.path.insert(0, os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        'dstat_interface'))
+
+import serial
+import stream_parser
+
+def make_stream(samples, databytes):
+    """Returns a str of samples B frames followed by the 'no' terminator."""
+    frames = []
+    for i in range(samples):
+        payload = "".join(chr(random.randint(0, 255))
+                          for j in range(databytes))
+        frames.append("".join(("B\n", payload, "\n")))
+        if i == samples // 2:
+            frames.append("S\n")
+    frames.append("#INFO: benchmark\n")
+    frames.append("no\n")
+    return "".join(frames)
+
+def _writer(fd, stream):
+    view = buffer(stream)
+    while view:
+        written = os.write(fd, view[:4096])
+        view = view[written:]
+    time.sleep(5)  # keep master open until reader is done
+
+def legacy_loop(ser, databytes):
+    """Previous serial_handler loop. Returns number of samples read."""
+    samples = 0
+    for line in ser:
+        if line.startswith('B'):
+            ser.read(size=databytes)
+            samples += 1
+        elif line.startswith('S'):
+            pass
+        elif line.lstrip().startswith("#"):
+            pass
+        elif line.lstrip().startswith("no"):
+            return samples
+    return samples
+
+def parser_loop(ser, databytes):
+    """FrameParser based loop. Returns number of samples read."""
+    samples = 0
+    parser = stream_parser.FrameParser(databytes)
+    while True:
+        parser.read(ser)
+        for event, payload in parser.events():
+            if event == stream_parser.BINARY:
+                samples += 1
+            elif event == stream_parser.END:
+                return samples
+
+def run(loop, stream, databytes):
+    """Runs loop against stream. Returns (samples, seconds)."""
+    master, slave = pty.openpty()
+    tty.setraw(slave)
+    ser = serial.Serial(os.ttyname(slave), baudrate=1000000, timeout=1)
+    writer = mp.Process(target=_writer, args=(master, stream))
+
+    start = time.time()
+    writer.start()
+    samples = loop(ser, databytes)
+    elapsed = time.time() - start
+
+    writer.terminate()
+    ser.close()
+    os.close(master)
+    os.close(slave)
+    return samples, elapsed
+
+if __name__ == "__main__":
+    samples = 50000
+    databytes = 8
+    if len(sys.argv) > 1:
+        samples = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        databytes = int(sys.argv[2])
+
+    stream = make_stream(samples, databytes)
+    print "%i samples, %i bytes/sample, %i bytes total" % (
+            samples, databytes, len(stream))
+
+    results = {}
+    for name, loop in (("legacy", legacy_loop), ("parser", parser_loop)):
+        count, elapsed = run(loop, stream, databytes)
+        results[name] = elapsed
+        print "%-8s %8i samples %8.3f s %12.0f samples/s" % (
+                name, count, elapsed, count/elapsed)
+
+    print "speedup: %.1fx" % (results["legacy"]/results["parser"])
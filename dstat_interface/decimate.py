@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+#     DStat Interface - An interface for the open hardware DStat potentiostat
+#     Copyright (C) 2014  Michael D. M. Dryden -
+#     Wheeler Microfluidics Laboratory <http://microfluidics.utoronto.ca>
+#
+#
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Peak-preserving decimation of growing data for plotting.
+
+Samples are grouped into buckets of consecutive samples and only the minimum
+and maximum of each bucket are plotted, in the order they occurred. Unlike
+taking every nth sample this never drops a spike: with at least one bucket
+per pixel column the decimated line looks the same as the full one.
+"""
+
+import numpy as np
+
+class MinMaxDecimator(object):
+    """Incremental min/max decimation of one growing array.
+
+    Completed buckets are kept as sample indices, so each update only
+    looks at samples that arrived since the last one plus the partial last
+    bucket. When there are more than the requested number of buckets,
+    neighbouring buckets are merged pairwise and the bucket size doubles.
+
+    The minimum and maximum of all samples seen are kept as well and are
+    available as bounds after each update.
+
+    Public methods:
+    set_buckets(self, buckets)
+    reset(self)
+    update(self, y)
+    """
+    def __init__(self, buckets=1000):
+        """Keyword arguments:
+        buckets -- maximum number of buckets (at most two points each)
+        """
+        self.buckets = max(int(buckets), 1)
+        self.reset()
+
+    def set_buckets(self, buckets):
+        """Changes maximum number of buckets, starting over if it changed."""
+        buckets = max(int(buckets), 1)
+        if buckets != self.buckets:
+            self.buckets = buckets
+            self.reset()
+
+    def reset(self):
+        """Forgets all samples seen."""
+        self.size = 1  # samples per bucket
+        self.count = 0  # samples in completed buckets
+        self.lo = np.empty(0, dtype=np.intp)  # index of minimum per bucket
+        self.hi = np.empty(0, dtype=np.intp)  # index of maximum per bucket
+        self.ymin = np.inf  # of completed buckets
+        self.ymax = -np.inf
+        self.bounds = None  # (min, max) of all samples, None if no samples
+
+    def _add(self, y, stop):
+        """Adds completed buckets for samples from self.count to stop."""
+        if stop <= self.count:
+            return
+        block = y[self.count:stop].reshape(-1, self.size)
+        offsets = np.arange(self.count, stop, self.size)
+        lo = offsets + block.argmin(axis=1)
+        hi = offsets + block.argmax(axis=1)
+        self.ymin = min(self.ymin, y[lo].min())
+        self.ymax = max(self.ymax, y[hi].max())
+        self.lo = np.concatenate((self.lo, lo))
+        self.hi = np.concatenate((self.hi, hi))
+        self.count = stop
+
+    def _merge(self, y):
+        """Halves the number of buckets by merging neighbours."""
+        if len(self.lo) % 2:  # last bucket goes back to the partial one
+            self.lo = self.lo[:-1]
+            self.hi = self.hi[:-1]
+            self.count -= self.size
+        a, b = self.lo[0::2], self.lo[1::2]
+        self.lo = np.where(y[b] < y[a], b, a)
+        a, b = self.hi[0::2], self.hi[1::2]
+        self.hi = np.where(y[b] > y[a], b, a)
+        self.size *= 2
+
+    def update(self, y):
+        """Returns sorted indices of the samples of y to plot.
+
+        Arguments:
+        y -- samples seen so far; earlier samples must not have changed
+             since the last call unless y is shorter (a new line)
+        """
+        length = len(y)
+        if length < self.count:
+            self.reset()
+
+        self._add(y, length - (length - self.count) % self.size)
+        while len(self.lo) > self.buckets:
+            self._merge(y)  # leaves less than one bucket of samples over
+
+        lo, hi = self.lo, self.hi
+        ymin, ymax = self.ymin, self.ymax
+        if self.count < length:  # partial last bucket
+            tail = y[self.count:length]
+            lo = np.append(lo, self.count + tail.argmin())
+            hi = np.append(hi, self.count + tail.argmax())
+            ymin = min(ymin, y[lo[-1]])
+            ymax = max(ymax, y[hi[-1]])
+        self.bounds = (ymin, ymax) if length else None
+
+        indices = np.column_stack((np.minimum(lo, hi),
+                                   np.maximum(lo, hi))).ravel()
+        if len(indices):
+            indices = indices[np.r_[True, np.diff(indices) != 0]]
+        return indices
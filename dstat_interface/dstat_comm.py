@@ -19,35 +19,56 @@
 
 import serial
 from serial.tools import list_ports
+import os
 import time
+import select
+import errno
+import re
 import struct
 import multiprocessing as mp
+import numpy as np
+import stream_parser
+import sample_ring
+import serial_capture
+import storage
 from errors import InputError, VarError, ErrorLogger
 _logger = ErrorLogger(sender="dstat_comm")
 
-def _serial_process(ser_port, proc_pipe, ctrl_pipe, data_pipe):
-    ser = delayedSerial(ser_port, baudrate=1000000, timeout=1)
+# Pipelined experiment start (see Experiment.validate_batch)
+PIPELINE_MAX_BYTES = 128
+_PIPELINE_COMMAND = re.compile(r'^E[A-Z][-0-9A-F ]* $')  # rates are hex
+
+def _serial_process(ser_port, proc_pipe, ctrl_pipe, data_pipe,
+                    pacing='legacy', ring=None, capture=None, replay=None,
+                    replay_speed=1.):
+    if replay is None:
+        ser = delayedSerial(ser_port, baudrate=1000000, timeout=1,
+                            pacing=pacing, capture=capture)
+    else:
+        ser = serial_capture.ReplaySerial(replay, speed=replay_speed)
     
     _logger.error("_serial_process() Connecting", 'INFO')
     
     ser.write("ck")
     
     ser.flushInput()
-    ser.write('!')
     
-    for i in range(10):
-        if not ser.read()=="C":
-            time.sleep(.5)
-            ser.write('!')
-        else:
-            break
+    try:
+        handshake(ser)
+    except serial.SerialException as err:
+        _logger.error(err, 'ERR')
+
+    dispatch_stats = TimingStats("dispatch")
+    watch_serial = hasattr(ser, 'fileno')  # not when replaying
 
     while True:
+        ready = _wait_readable([ctrl_pipe, proc_pipe], ser, watch_serial)
+        
         # These can only be called when no experiment is running
-        if ctrl_pipe.poll(): 
+        if ctrl_pipe in ready: 
             ctrl_buffer = ctrl_pipe.recv()
             
-            if ctrl_buffer == ('a' or "DISCONNECT"):
+            if ctrl_buffer in ('a', "DISCONNECT"):
                 proc_pipe.send("ABORT")
                 ser.write('a')
                 _logger.error("_serial_process(): ABORT", 'INFO')
@@ -59,32 +80,112 @@ def _serial_process(ser_port, proc_pipe, ctrl_pipe, data_pipe):
                     return False
     
             
-        elif proc_pipe.poll():
+        elif proc_pipe in ready:
             while ctrl_pipe.poll():
                 ctrl_pipe.recv()
             
-            return_code = proc_pipe.recv().run(ser, ctrl_pipe, data_pipe)
+            task = proc_pipe.recv()
+            task.dispatch_latency = time.time() - getattr(task, 'queued',
+                                                          time.time())
+            dispatch_stats.add(task.dispatch_latency)
+            _logger.error("".join(("_serial_process: dispatched ",
+                                   task.__class__.__name__, " after ",
+                                   "%.2f ms" % (task.dispatch_latency*1000))),
+                          'DBG')
+            
+            if isinstance(task, Experiment):
+                task.ring = ring
+            return_code = task.run(ser, ctrl_pipe, data_pipe)
             e = "_serial_process: "
             e += str(return_code)
             _logger.error(e,'INFO')
 
             proc_pipe.send(return_code)
+            stats = [getattr(ser, 'write_stats', None),
+                     getattr(ser, 'handshake_stats', None), dispatch_stats]
+            _logger.error("".join(("_serial_process: ",
+                                   "; ".join([str(i) for i in stats
+                                              if i is not None]))), 'INFO')
+            watch_serial = hasattr(ser, 'fileno')
+            if getattr(ser, 'capture', None) is not None:
+                ser.capture.flush()
         
-        else:
+        elif ser in ready:
+            # unsolicited output while idle
+            try:
+                for line in ser.read(max(ser.inWaiting(), 1)).splitlines():
+                    if line.strip():
+                        _logger.error("".join(("DSTAT (idle): ",
+                                               line.strip())), 'DBG')
+            except serial.SerialException as err:
+                _logger.error(err, 'WAR')
+                watch_serial = False  # until next task
+
+def _wait_readable(pipes, ser, watch_serial):
+    """Blocks until one of pipes (or ser, if watch_serial) has data to read.
+    Returns list of those that do. select() only handles sockets on
+    Windows, so there the pipes are polled every .1 s instead.
+    """
+    if os.name == 'nt':
+        while True:
+            ready = [i for i in pipes if i.poll()]
+            if ready:
+                return ready
             time.sleep(.1)
+    
+    if watch_serial:
+        pipes = pipes + [ser]
+    while True:
+        try:
+            return select.select(pipes, [], [])[0]
+        except select.error as err:
+            if err[0] != errno.EINTR:
+                raise
             
 
 
 class SerialConnection(object):
-    def __init__(self, ser_port):
+    def __init__(self, ser_port, pacing='legacy', ring=False, capture=None,
+                 replay=None, replay_speed=1.):
+        """Starts serial process connected to ser_port.
+        
+        Arguments:
+        ser_port -- address of serial port to use (ignored if replay is set)
+        
+        Keyword arguments:
+        pacing -- key of PACING or WritePacing instance used for writes
+        ring -- if True, experiment data is passed through a shared memory
+            sample_ring.SampleRing (self.ring) and data_pipe only carries a
+            None message whenever new samples are available
+        capture -- path of file to record serial traffic to (see
+            serial_capture)
+        replay -- path of capture file to read from instead of ser_port
+        replay_speed -- speed factor of replay or None for as fast as
+            possible
+        """
         self.proc_pipe_p, self.proc_pipe_c = mp.Pipe(duplex=True)
         self.ctrl_pipe_p, self.ctrl_pipe_c = mp.Pipe(duplex=True)
         self.data_pipe_p, self.data_pipe_c = mp.Pipe(duplex=True)
+        
+        if ring:
+            self.ring = sample_ring.SampleRing()
+        else:
+            self.ring = None
     
         self.proc = mp.Process(target=_serial_process, args=(ser_port,
                                 self.proc_pipe_c, self.ctrl_pipe_c,
-                                self.data_pipe_c))
+                                self.data_pipe_c, pacing, self.ring, capture,
+                                replay, replay_speed))
         self.proc.start()
+    
+    def send_task(self, task):
+        """Queues task (an object with a run(ser, ctrl_pipe, data_pipe)
+        method) for the serial process. task.queued is set to the time it
+        was sent; the serial process records the delay until it starts
+        running in task.dispatch_latency.
+        """
+        task.queued = time.time()
+        self.proc_pipe_p.send(task)
         
 
 class VersionCheck:
@@ -130,18 +231,28 @@ class VersionCheck:
         finally:
             return status
 
-def version_check(ser_port):
+def version_check(ser_port, pacing='legacy', ring=False, capture=None,
+                  replay=None, replay_speed=1.):
     """Tries to contact DStat and get version. Returns a list of
     [(major, minor), serial instance]. If no response, returns empty tuple.
         
     Arguments:
     ser_port -- address of serial port to use
+    
+    Keyword arguments:
+    pacing -- key of PACING or WritePacing instance used for writes
+    ring -- pass experiment data through shared memory (see
+        SerialConnection)
+    capture, replay, replay_speed -- record or replay serial traffic (see
+        SerialConnection)
     """
     try:        
         global serial_instance
-        serial_instance = SerialConnection(ser_port)
+        serial_instance = SerialConnection(ser_port, pacing=pacing, ring=ring,
+                                           capture=capture, replay=replay,
+                                           replay_speed=replay_speed)
         
-        serial_instance.proc_pipe_p.send(VersionCheck())
+        serial_instance.send_task(VersionCheck())
         result = serial_instance.proc_pipe_p.recv()
         if result == "SERIAL_ERROR":
             buffer = 1
@@ -165,14 +276,22 @@ class Settings:
         """
         
         self.ser = ser
+        status = "DONE"
         
-        if 'w' in self.task:
-            self.write()
+        try:
+            if 'w' in self.task:
+                self.write()
+        except serial.SerialException as err:
+            _logger.error(err, 'ERR')
+            status = "SERIAL_ERROR"
             
         if 'r' in self.task:
-            data_pipe.send(self.read())
-        
-        status = "DONE"
+            try:
+                data_pipe.send(self.read())
+            except serial.SerialException as err:
+                _logger.error(err, 'ERR')
+                data_pipe.send({})
+                status = "SERIAL_ERROR"
         
         return status
         
@@ -180,11 +299,7 @@ class Settings:
         settings = {}
         
         self.ser.flushInput()
-        self.ser.write('!')
-                
-        while not self.ser.read()=="C":
-            time.sleep(.5)
-            self.ser.write('!')
+        handshake(self.ser)
             
         self.ser.write('SR')
         for line in self.ser:
@@ -208,11 +323,7 @@ class Settings:
         
     def write(self):
         self.ser.flushInput()
-        self.ser.write('!')
-                
-        while not self.ser.read()=="C":
-            time.sleep(.5)
-            self.ser.write('!')
+        handshake(self.ser)
             
         write_buffer = range(len(self.settings))
     
@@ -237,7 +348,7 @@ def read_settings():
     while serial_instance.data_pipe_p.poll():
         serial_instance.data_pipe_p.recv()
     
-    serial_instance.proc_pipe_p.send(Settings(task='r'))
+    serial_instance.send_task(Settings(task='r'))
     settings = serial_instance.data_pipe_p.recv()
     
     _logger.error("".join(("read_settings: ",
@@ -252,7 +363,7 @@ def write_settings():
     while serial_instance.data_pipe_p.poll():
         serial_instance.data_pipe_p.recv()
     
-    serial_instance.proc_pipe_p.send(Settings(task='w', settings=settings))
+    serial_instance.send_task(Settings(task='w', settings=settings))
     
     _logger.error("".join(("write_settings: ",
                      serial_instance.proc_pipe_p.recv())),'DBG')
@@ -269,12 +380,12 @@ class LightSensor:
         """
         
         ser.flushInput()
-        ser.write('!')
-                
-        while not ser.read()=="C":
-            time.sleep(.5)
-            ser.write('!')
-    
+        try:
+            handshake(ser)
+        except serial.SerialException as err:
+            _logger.error(err, 'ERR')
+            data_pipe.send(None)
+            return "SERIAL_ERROR"
             
         ser.write('T')
         for line in ser:
@@ -305,7 +416,7 @@ def read_light_sensor():
     while serial_instance.data_pipe_p.poll():
         serial_instance.data_pipe_p.recv()
         
-    serial_instance.proc_pipe_p.send(LightSensor())
+    serial_instance.send_task(LightSensor())
     
     _logger.error("".join(("read_light_sensor: ",
                      serial_instance.proc_pipe_p.recv())),'DBG')
@@ -313,14 +424,154 @@ def read_light_sensor():
     return serial_instance.data_pipe_p.recv()
     
 
+class TimingStats(object):
+    """Accumulates durations (in seconds) of a repeated operation."""
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+        self.last = 0.
+        
+    def add(self, seconds):
+        """Record one duration."""
+        self.count += 1
+        self.total += seconds
+        self.last = seconds
+        if seconds > self.max:
+            self.max = seconds
+    
+    def mean(self):
+        """Returns mean duration or 0 if nothing recorded."""
+        if self.count == 0:
+            return 0.
+        return self.total/self.count
+    
+    def __str__(self):
+        return "%s: n=%i mean=%.2f ms max=%.2f ms last=%.2f ms" % (
+                self.name, self.count, self.mean()*1000, self.max*1000,
+                self.last*1000)
+
+class WritePacing(object):
+    """Describes how commands are paced to the DStat's receive buffer.
+    Commands are written in chunks of up to chunk_size bytes, waiting
+    chunk_delay seconds after each chunk so the firmware can empty its
+    buffer. A chunk_size of 0 writes each command in one piece.
+    """
+    def __init__(self, chunk_size, chunk_delay):
+        self.chunk_size = chunk_size
+        self.chunk_delay = chunk_delay
+
+# legacy: old behaviour, one byte per ms
+# chunked: fills the XMEGA's 64 byte USB endpoint buffer at most once per ms;
+#          opt-in until checked against the firmware on hardware
+# none: no pacing, for devices that don't need it (e.g. emulators)
+PACING = {'legacy' : WritePacing(1, .001),
+          'chunked' : WritePacing(64, .001),
+          'none' : WritePacing(0, 0)}
+
 class delayedSerial(serial.Serial): 
-    """Extends Serial.write so that characters are output individually
-    with a slight delay
+    """Extends Serial.write so that commands are output in chunks paced
+    according to a WritePacing instance. Time spent writing each command
+    is recorded in self.write_stats. Optionally records all traffic to a
+    serial_capture file.
     """
+    def __init__(self, *args, **kwargs):
+        """Accepts same arguments as serial.Serial plus:
+        
+        Keyword arguments:
+        pacing -- key of PACING or WritePacing instance (default 'legacy')
+        capture -- path of capture file or None
+        """
+        capture = kwargs.pop('capture', None)
+        self.capture = None
+        if capture is not None:
+            self.capture = serial_capture.CaptureWriter(capture)
+            _logger.error("Capturing serial traffic to %s" % capture, 'INFO')
+        pacing = kwargs.pop('pacing', 'legacy')
+        if not isinstance(pacing, WritePacing):
+            pacing = PACING[pacing]
+        self.pacing = pacing
+        self.write_stats = TimingStats("write")
+        self.handshake_stats = TimingStats("handshake")
+        self.handshake_failures = 0
+        
+        serial.Serial.__init__(self, *args, **kwargs)
+    
+    def read(self, size=1):
+        data = serial.Serial.read(self, size)
+        if self.capture is not None:
+            self.capture.record(serial_capture.RECEIVED, data)
+        return data
+    
+    def close(self):
+        serial.Serial.close(self)
+        if self.capture is not None:
+            self.capture.close()
+            self.capture = None
+    
     def write(self, data):
-        for i in data:
-            serial.Serial.write(self, i)
-            time.sleep(.001)
+        if self.capture is not None:
+            self.capture.record(serial_capture.SENT, data)
+        start = time.time()
+        
+        size = self.pacing.chunk_size
+        if size <= 0:
+            size = max(len(data), 1)
+        
+        for i in range(0, len(data), size):
+            serial.Serial.write(self, data[i:i+size])
+            if self.pacing.chunk_delay:
+                time.sleep(self.pacing.chunk_delay)
+        
+        self.write_stats.add(time.time() - start)
+        _logger.error("".join(("write ", repr(data[:16]), " (",
+                               str(len(data)), " bytes): ",
+                               "%.2f ms" % (self.write_stats.last*1000))),
+                      'DBG')
+
+def handshake(ser, first_wait=.02, max_wait=.5, deadline=5.):
+    """Sends '!' to DStat until it replies 'C'. Waits first_wait seconds for
+    the reply, doubling the wait after each unanswered attempt up to
+    max_wait. Round trip times of successful handshakes are added to
+    ser.handshake_stats if ser has it.
+    
+    Returns round trip time in seconds. Raises serial.SerialException if
+    there is no reply within deadline seconds.
+    """
+    start = time.time()
+    wait = first_wait
+    timeout = ser.timeout
+    stats = getattr(ser, 'handshake_stats', None)
+    
+    try:
+        while True:
+            sent = time.time()
+            ser.write('!')
+            ser.timeout = wait
+            
+            reply = ser.read()
+            while reply and reply != 'C' and time.time() - sent < wait:
+                reply = ser.read()
+            
+            if reply == 'C':
+                rtt = time.time() - sent
+                if stats is not None:
+                    stats.add(rtt)
+                return rtt
+            
+            if time.time() - start >= deadline:
+                if hasattr(ser, 'handshake_failures'):
+                    ser.handshake_failures += 1
+                raise serial.SerialException(
+                        "No handshake reply from DStat after %.1f s" %
+                        (time.time() - start))
+            
+            _logger.error("handshake: no reply, retrying", 'DBG')
+            wait = min(wait*2, max_wait,
+                       max(deadline - (time.time() - start), 0))
+    finally:
+        ser.timeout = timeout
 
 class SerialDevices(object):
     """Retrieves and stores list of serial devices in self.ports"""
@@ -339,14 +590,29 @@ class Experiment(object):
     """Store and acquire a potentiostat experiment. Meant to be subclassed
     to by different experiment types and not used instanced directly.
     """
+    # Decoded samples are sent to data_pipe in chunks of up to chunk_size
+    # samples, held for at most chunk_latency seconds. Can be changed per
+    # instance before sending to the serial process.
+    chunk_size = 2000
+    chunk_latency = .05
+    # sample_ring.SampleRing set by _serial_process if data is passed through
+    # shared memory instead of data_pipe
+    ring = None
+    # send all commands in one write if self.validate_batch() allows it
+    pipelined = False
+    # add timestamps to data_pipe messages (see flush_batch), for benchmarks
+    profile = False
+    # single scan, so data can be kept in a storage.MappedStore
+    mappable = False
 
     def __init__(self, parameters):
         """Adds commands for gain and ADC."""
         self.parameters = parameters
         self.databytes = 8
+        self.dtype = np.dtype([('voltage', '<u2'), ('current', '<i4')])
         self.scan = 0
 
-        self.data_extra = []  # must be defined even when not needed
+        self.init_storage()
         
         major, minor = self.parameters['version']
         
@@ -378,6 +644,32 @@ class Experiment(object):
         self.commands[1] += (self.parameters['re_short'])
         self.commands[1] += " "
 
+    def init_storage(self, extra=()):
+        """Creates self.store, a storage.DataStore with channels x, y and
+        those in extra. self.data is a view of x and y, self.data_extra of
+        the extra channels (or [] if there are none).
+        """
+        self.store = storage.DataStore(('x', 'y') + tuple(extra))
+        self.data = self.store.view(('x', 'y'))
+        if extra:
+            self.data_extra = self.store.view(extra)
+        else:
+            self.data_extra = []  # must be defined even when not needed
+
+    def map_storage(self, path):
+        """Replaces the empty self.store with a storage.MappedStore at path
+        with the same channels, for long experiments. Returns the new store,
+        or None if self.mappable is False.
+        """
+        if not self.mappable:
+            return None
+        channels = self.store.channels
+        self.store = storage.MappedStore(path, channels)
+        self.data = self.store.view(('x', 'y'))
+        if self.data_extra:
+            self.data_extra = self.store.view(channels[2:])
+        return self.store
+    
     def run(self, ser, ctrl_pipe, data_pipe):
         """Execute experiment. Connects and sends handshake signal to DStat
         then sends self.commands. Don't call directly as a process in Windows,
@@ -386,6 +678,16 @@ class Experiment(object):
         self.serial = ser
         self.ctrl_pipe = ctrl_pipe
         self.data_pipe = data_pipe
+        self.parser = stream_parser.FrameParser(self.databytes, batch=True)
+        self.frame_dtype = stream_parser.frame_dtype(self.dtype)
+        self.pending = []
+        self.pending_count = 0
+        self.pending_since = 0
+        self.pending_read = 0
+        self.read_time = 0
+        self.run_start = time.time()
+        self.startup_time = None
+        self.acks = 0
         
         _logger.error("Experiment running", "INFO")
         
@@ -393,16 +695,23 @@ class Experiment(object):
             self.serial.flushInput()
             status = "DONE"
             
-            for i in self.commands:
-                _logger.error("".join(("Command: ",i)), "INFO")
-                self.serial.write('!')
-                
-                while not self.serial.read().startswith("C"):
-                    pass
-    
-                self.serial.write(i)
-                if not self.serial_handler():
-                    status = "ABORT"
+            if self.pipelined and self.validate_batch():
+                _logger.error("".join(("Commands (pipelined): ",
+                                       " ".join(self.commands))), "INFO")
+                self.serial.write("".join(["!" + i for i in self.commands]))
+                for n in range(len(self.commands)):
+                    if not self.serial_handler(
+                                        last=(n == len(self.commands) - 1)):
+                        status = "ABORT"
+            else:
+                for n, i in enumerate(self.commands):
+                    _logger.error("".join(("Command: ",i)), "INFO")
+                    handshake(self.serial)
+                    self.serial.write(i)
+                    if n == len(self.commands) - 1:
+                        self.startup_done()
+                    if not self.serial_handler():
+                        status = "ABORT"
             
             self.data_postprocessing()
         except serial.SerialException:
@@ -412,12 +721,43 @@ class Experiment(object):
                 self.ctrl_pipe.recv()
         return status
     
-    def serial_handler(self):
+    def validate_batch(self):
+        """Returns True if self.commands can be sent in one write instead of
+        handshaking for each: all but the last command must be ADC or gain
+        setup commands, which the firmware finishes immediately, all must
+        be plain space terminated commands and together they must fit in
+        PIPELINE_MAX_BYTES.
+        """
+        if len(self.commands) < 2:
+            return False
+        for i in self.commands[:-1]:
+            if not i.startswith(('EA', 'EG')):
+                return False
+        for i in self.commands:
+            if not _PIPELINE_COMMAND.match(i):
+                return False
+        return len(self.commands) + len("".join(self.commands)) <= \
+                                                            PIPELINE_MAX_BYTES
+    
+    def startup_done(self):
+        """Records and logs time from start of self.run until the DStat
+        accepted the last command.
+        """
+        self.startup_time = time.time() - self.run_start
+        _logger.error("".join(("Experiment start-up: ",
+                               "%.2f ms" % (self.startup_time*1000),
+                               " (pipelined)" if self.acks else "")), "INFO")
+    
+    def serial_handler(self, last=True):
         """Handles incoming serial transmissions from DStat. Returns False
         if stop button pressed and sends abort signal to instrument. Sends
-        data to self.data_pipe as result of self.data_handler).
+        data to self.data_pipe with self.send_batch as result of
+        self.batch_handler.
+        
+        Keyword arguments:
+        last -- if False, more pipelined commands follow, so data after the
+            end of this command's output is kept
         """
-        scan = 0
         try:
             while True:
                 if self.ctrl_pipe.poll():
@@ -426,44 +766,127 @@ class Experiment(object):
                     if input == ('a' or "DISCONNECT"):
                         self.serial.write('a')
                         _logger.error("serial_handler: ABORT pressed!","INFO")
+                        self.flush_batch()
                         return False
-                            
-                for line in self.serial:
-                    if self.ctrl_pipe.poll():
-                        if self.ctrl_pipe.recv() == 'a':
-                            self.serial.write('a')
-                            _logger.error("serial_handler: ABORT pressed!","INFO")
-                            return False
-                            
-                    if line.startswith('B'):
-                        data = self.data_handler(
-                                (scan, self.serial.read(size=self.databytes)))
-                        self.data_pipe.send(data)
-                    elif line.startswith('S'):
+                
+                # events already buffered first: after a pipelined
+                # command's END they are the next command's output
+                for event, payload in self.parser.events():
+                    if event == stream_parser.BLOCK:
+                        self.send_batch(self.batch_handler((self.scan,
+                                np.frombuffer(payload, dtype=self.frame_dtype))))
+                    elif event == stream_parser.BINARY:
+                        self.send_batch(self.batch_handler((self.scan,
+                                np.frombuffer(payload, dtype=self.dtype))))
+                    elif event == stream_parser.SCAN:
                         self.scan += 1
-                    elif line.lstrip().startswith("#"):
-                        _logger.error("".join(
-                                        ("DSTAT: ",line.lstrip().rstrip())), "INFO")
-                    elif line.lstrip().startswith("no"):
-                        _logger.error("".join(
-                                        ("DSTAT: ",line.lstrip().rstrip())), "DBG")
-                        self.serial.flushInput()
+                    elif event == stream_parser.MESSAGE:
+                        _logger.error("".join(("DSTAT: ", payload)), "INFO")
+                    elif event == stream_parser.ACK:
+                        self.acks += 1
+                        if self.acks == len(self.commands):
+                            self.startup_done()
+                    elif event == stream_parser.END:
+                        _logger.error("".join(("DSTAT: ", payload)), "DBG")
+                        if last:
+                            self.serial.flushInput()
+                            self.parser.clear()
+                        self.flush_batch()
                         return True
+                
+                if (self.pending_count >= self.chunk_size or
+                        (self.pending_count and time.time() >=
+                         self.pending_since + self.chunk_latency)):
+                    self.flush_batch()
+                
+                if self.pending_count and not self.serial.inWaiting():
+                    # wait for more samples instead of sending a short chunk
+                    remaining = (self.pending_since + self.chunk_latency -
+                                 time.time())
+                    if remaining > 0:
+                        time.sleep(remaining)
+                    
+                self.parser.read(self.serial)
+                self.read_time = time.time()
                         
         except serial.SerialException:
             return False
     
     
     def data_handler(self, data_input):
-        """Takes data_input as tuple -- (scan, data).
+        """Takes data_input as tuple -- (scan, data) where data is the str
+        of a single sample. Decodes it with self.batch_handler.
         Returns:
         (scan number, [voltage, current]) -- voltage in mV, current in A
         """
         scan, data = data_input
-        voltage, current = struct.unpack('<Hl', data) #uint16 + int32
+        scan, columns = self.batch_handler(
+                                (scan, np.frombuffer(data, dtype=self.dtype)))
+        return (scan, [float(i[0]) for i in columns])
+    
+    def batch_handler(self, data_input):
+        """Takes data_input as tuple -- (scan, samples) where samples is a
+        structured array with fields of self.dtype.
+        Returns:
+        (scan number, [voltage, current]) -- arrays, voltage in mV,
+            current in A
+        """
+        scan, samples = data_input
         return (scan,
-                [(voltage-32768)*3000./65536,
-                (current+self.gain_trim)*(1.5/self.gain/8388607)])
+                [(samples['voltage']-32768.)*(3000./65536),
+                 (samples['current']+float(self.gain_trim))*
+                    (1.5/self.gain/8388607)])
+    
+    def send_batch(self, data):
+        """Queues output of self.batch_handler to be sent to self.data_pipe
+        by self.flush_batch.
+        """
+        if not self.pending_count:
+            self.pending_since = time.time()
+            self.pending_read = self.read_time
+        self.pending.append(data)
+        self.pending_count += len(data[1][0])
+    
+    def flush_batch(self):
+        """Sends queued samples to self.data_pipe as (scan, array) tuples,
+        one per scan. array has one row per column of self.batch_handler's
+        output. If self.ring is set, samples are written to it instead and
+        a single None is sent to signal their arrival.
+        
+        If self.profile is set, a tuple of timestamps (read, decoded, sent)
+        of the oldest sample is appended to each message -- when the serial
+        read returning it finished, when it was queued and when the message
+        was sent. Messages become (scan, array, stamps) tuples, and stamps
+        replaces None when using self.ring.
+        """
+        chunks = []
+        for scan, columns in self.pending:
+            if chunks and chunks[-1][0] == scan:
+                chunks[-1][1].append(columns)
+            else:
+                chunks.append((scan, [columns]))
+        
+        for scan, blocks in chunks:
+            data = np.hstack([np.vstack(i) for i in blocks])
+            if self.ring is None:
+                if self.profile:
+                    self.data_pipe.send((scan, data, (self.pending_read,
+                                        self.pending_since, time.time())))
+                else:
+                    self.data_pipe.send((scan, data))
+            elif self.ring.write(scan, data) < data.shape[1]:
+                _logger.error("flush_batch: sample ring full, samples dropped",
+                              'WAR')
+        
+        if chunks and self.ring is not None:
+            if self.profile:
+                self.data_pipe.send((self.pending_read, self.pending_since,
+                                     time.time()))
+            else:
+                self.data_pipe.send(None)
+        
+        self.pending = []
+        self.pending_count = 0
     
     def data_postprocessing(self):
         """No data postprocessing done by default, can be overridden
@@ -473,9 +896,13 @@ class Experiment(object):
 
 class CALExp(Experiment):
     """Offset calibration experiment"""
+    pipelined = False  # line based serial_handler handles one command
+
     def __init__(self, parameters):
         self.parameters = parameters
         self.databytes = 8
+        self.dtype = np.dtype([('seconds', '<u2'), ('milliseconds', '<u2'),
+                               ('current', '<i4')])
         self.scan = 0
         self.data = []
 
@@ -559,15 +986,19 @@ class CALExp(Experiment):
 
 class Chronoamp(Experiment):
     """Chronoamperometry experiment"""
+    mappable = True
+
     def __init__(self, parameters):
         super(Chronoamp, self).__init__(parameters)
 
         self.datatype = "linearData"
         self.xlabel = "Time (s)"
         self.ylabel = "Current (A)"
-        self.data = [[], []]
+        self.init_storage()
         self.datalength = 2
         self.databytes = 8
+        self.dtype = np.dtype([('seconds', '<u2'), ('milliseconds', '<u2'),
+                               ('current', '<i4')])
         self.xmin = 0
         self.xmax = 0
         
@@ -586,14 +1017,13 @@ class Chronoamp(Experiment):
             self.commands[2] += " "
         self.commands[2] += "0 " # disable photodiode interlock
             
-    def data_handler(self, data_input):
+    def batch_handler(self, data_input):
         """Overrides Experiment method to not convert x axis to mV."""
-        scan, data = data_input
-        # 2*uint16 + int32
-        seconds, milliseconds, current = struct.unpack('<HHl', data)
+        scan, samples = data_input
         return (scan,
-                [seconds+milliseconds/1000.,
-                (current+self.gain_trim)*(1.5/self.gain/8388607)])
+                [samples['seconds']+samples['milliseconds']/1000.,
+                 (samples['current']+float(self.gain_trim))*
+                    (1.5/self.gain/8388607)])
 
 class PDExp(Chronoamp):
     """Photodiode/PMT experiment"""
@@ -603,9 +1033,11 @@ class PDExp(Chronoamp):
         self.datatype = "linearData"
         self.xlabel = "Time (s)"
         self.ylabel = "Current (A)"
-        self.data = [[], []]
+        self.init_storage()
         self.datalength = 2
         self.databytes = 8
+        self.dtype = np.dtype([('seconds', '<u2'), ('milliseconds', '<u2'),
+                               ('current', '<i4')])
         self.xmin = 0
         self.xmax = self.parameters['time']
         
@@ -630,15 +1062,19 @@ class PDExp(Chronoamp):
 
 class PotExp(Experiment):
     """Potentiometry experiment"""
+    mappable = True
+
     def __init__(self, parameters):
         super(PotExp, self).__init__(parameters)
 
         self.datatype = "linearData"
         self.xlabel = "Time (s)"
         self.ylabel = "Voltage (V)"
-        self.data = [[], []]
+        self.init_storage()
         self.datalength = 2
         self.databytes = 8
+        self.dtype = np.dtype([('seconds', '<u2'), ('milliseconds', '<u2'),
+                               ('voltage', '<i4')])
         self.xmin = 0
         self.xmax = self.parameters['time']
         
@@ -647,13 +1083,12 @@ class PotExp(Experiment):
         self.commands[2] += str(self.parameters['time'])
         self.commands[2] += " 1 " #potentiometry mode
 
-    def data_handler(self, data_input):
+    def batch_handler(self, data_input):
         """Overrides Experiment method to not convert x axis to mV."""
-        scan, data = data_input
-        # 2*uint16 + int32
-        seconds, milliseconds, voltage = struct.unpack('<HHl', data)
+        scan, samples = data_input
         return (scan,
-                [seconds+milliseconds/1000., voltage*(1.5/8388607.)])
+                [samples['seconds']+samples['milliseconds']/1000.,
+                 samples['voltage']*(1.5/8388607.)])
 
 class LSVExp(Experiment):
     """Linear Scan Voltammetry experiment"""
@@ -663,9 +1098,10 @@ class LSVExp(Experiment):
         self.datatype = "linearData"
         self.xlabel = "Voltage (mV)"
         self.ylabel = "Current (A)"
-        self.data = [[], []]
+        self.init_storage()
         self.datalength = 2
         self.databytes = 6  # uint16 + int32
+        self.dtype = np.dtype([('voltage', '<u2'), ('current', '<i4')])
         self.xmin = self.parameters['start']
         self.xmax = self.parameters['stop']
         
@@ -696,9 +1132,10 @@ class CVExp(Experiment):
         self.datatype = "CVData"
         self.xlabel = "Voltage (mV)"
         self.ylabel = "Current (A)"
-        self.data = [[], []]
+        self.init_storage()
         self.datalength = 2 * self.parameters['scans']  # x and y for each scan
         self.databytes = 6  # uint16 + int32
+        self.dtype = np.dtype([('voltage', '<u2'), ('current', '<i4')])
         self.xmin = self.parameters['v1']
         self.xmax = self.parameters['v2']
         
@@ -733,14 +1170,14 @@ class SWVExp(Experiment):
         self.datatype = "SWVData"
         self.xlabel = "Voltage (mV)"
         self.ylabel = "Current (A)"
-        self.data = [[], []]  # only difference stored here
+        self.init_storage(extra=('forward', 'reverse'))  # y is difference
         self.datalength = 2 * self.parameters['scans']
         self.databytes = 10
+        self.dtype = np.dtype([('voltage', '<u2'), ('forward', '<i4'),
+                               ('reverse', '<i4')])
         
         self.xmin = self.parameters['start']
         self.xmax = self.parameters['stop']
-
-        self.data_extra = [[], []]  
         
         self.commands += "E"
         self.commands[2] += "S"
@@ -768,14 +1205,21 @@ class SWVExp(Experiment):
         self.commands[2] += " "
     
     def data_handler(self, input_data):
-        """Overrides Experiment method to calculate difference current"""
+        """Overrides Experiment method to return all four columns of
+        self.batch_handler.
+        """
         scan, data = input_data
-        # uint16 + int32
-        voltage, forward, reverse = struct.unpack('<Hll', data)
-        f_trim = forward+self.gain_trim
-        r_trim = reverse+self.gain_trim
+        scan, columns = self.batch_handler(
+                                (scan, np.frombuffer(data, dtype=self.dtype)))
+        return (scan, [float(i[0]) for i in columns])
+    
+    def batch_handler(self, input_data):
+        """Overrides Experiment method to calculate difference current"""
+        scan, samples = input_data
+        f_trim = samples['forward']+float(self.gain_trim)
+        r_trim = samples['reverse']+float(self.gain_trim)
         
-        return (scan, [(voltage-32768)*3000./65536,
+        return (scan, [(samples['voltage']-32768.)*(3000./65536),
                        (f_trim-r_trim)*(1.5/self.gain/8388607),
                        f_trim*(1.5/self.gain/8388607),
                        r_trim*(1.5/self.gain/8388607)])
@@ -790,14 +1234,14 @@ class DPVExp(SWVExp):
         self.datatype = "SWVData"
         self.xlabel = "Voltage (mV)"
         self.ylabel = "Current (A)"
-        self.data = [[], []]  # only difference stored here
+        self.init_storage(extra=('forward', 'reverse'))  # y is difference
         self.datalength = 2
         self.databytes = 10
+        self.dtype = np.dtype([('voltage', '<u2'), ('forward', '<i4'),
+                               ('reverse', '<i4')])
         
         self.xmin = self.parameters['start']
         self.xmax = self.parameters['stop']
-
-        self.data_extra = [[], []]
         
         self.commands += "E"
         self.commands[2] += "D"
@@ -828,6 +1272,9 @@ class OCPExp(Experiment):
     """Open circuit potential measumement in statusbar."""
     def __init__(self):
         self.databytes = 8
+        self.dtype = np.dtype([('seconds', '<u2'), ('milliseconds', '<u2'),
+                               ('voltage', '<i4')])
+        self.scan = 0
         
         self.commands = ["EA", "EP"]
     
@@ -839,11 +1286,22 @@ class OCPExp(Experiment):
         self.commands[1] += "0 " # OCP measurement mode
         
     def data_handler(self, data_input):
-        """Overrides Experiment method to only send ADC values."""
+        """Overrides Experiment method to only return ADC value."""
         scan, data = data_input
-        # 2*uint16 + int32
-        seconds, milliseconds, voltage = struct.unpack('<HHl', data)
-        return (voltage/5.592405e6)
+        scan, columns = self.batch_handler(
+                                (scan, np.frombuffer(data, dtype=self.dtype)))
+        return float(columns[0][0])
+    
+    def batch_handler(self, data_input):
+        """Overrides Experiment method to only return ADC values."""
+        scan, samples = data_input
+        return (scan, [samples['voltage']/5.592405e6])
+    
+    def send_batch(self, data):
+        """Overrides Experiment method to send bare ADC values."""
+        scan, columns = data
+        for i in columns[0].tolist():
+            self.data_pipe.send(i)
         
 def measure_offset(time):
     gain_trim_table = [None, 'r100_trim', 'r3k_trim', 'r30k_trim', 'r300k_trim',
@@ -856,7 +1314,7 @@ def measure_offset(time):
     
     for i in range(1,8):
         parameters['gain'] = i
-        serial_instance.proc_pipe_p.send(CALExp(parameters))
+        serial_instance.send_task(CALExp(parameters))
         _logger.error("".join(
             ("measure_offset: ", serial_instance.proc_pipe_p.recv())),
             "INFO")
@@ -0,0 +1,303 @@
+#!/usr/bin/env python
+#     DStat Interface - An interface for the open hardware DStat potentiostat
+#     Copyright (C) 2014  Michael D. M. Dryden -
+#     Wheeler Microfluidics Laboratory <http://microfluidics.utoronto.ca>
+#
+#
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Chunked binary container for experiment data (.dstat).
+
+A file starts with MAGIC and a format version, followed by records of
+    <4s type><uint32 flags><uint64 length><payload>
+HEAD -- JSON header: channels with their dtypes plus experiment metadata
+        (parameters, commands, gain, timestamps, ...)
+DATA -- chunk of one scan: <uint16 scan><uint32 rows>, then each channel's
+        column in turn, zlib compressed if flags has COMPRESSED
+INDX -- JSON index of all chunks and metadata added when closing,
+        followed by <uint64 offset of INDX record>END_MAGIC
+A closed file ends with an index, so a scan can be read by seeking to its
+chunks without reading the rest. Appending removes the index and writes a
+new one on closing. A file that was never closed (e.g. after a crash) has
+no index; Reader rebuilds it by skipping from record to record.
+
+Usage: python dstat_file.py file  -- prints a summary
+"""
+
+import sys, os, json, struct, zlib
+from datetime import datetime
+
+import numpy as np
+
+from errors import InputError
+
+MAGIC = "DSTATDAT"
+END_MAGIC = "DSTATEND"
+VERSION = 1
+COMPRESSED = 1
+
+_FILE_HEADER = struct.Struct('<8sH')
+_RECORD = struct.Struct('<4sIQ')
+_CHUNK = struct.Struct('<HI')
+_TRAILER = struct.Struct('<Q8s')
+
+def _timestamp():
+    return datetime.now().replace(microsecond=0).isoformat()
+
+class Writer(object):
+    """Writes a .dstat file. Samples are buffered and written as a chunk
+    when chunk_rows have accumulated for a scan, when the scan changes and
+    on flush().
+
+    Public methods:
+    append(self, scan, columns)
+    flush(self)
+    close(self, metadata=None)
+    """
+    chunk_rows = 65536
+
+    def __init__(self, path, channels=None, metadata=None, dtypes=None,
+                 compress=False, append=False):
+        """Arguments:
+        path -- file path
+
+        Keyword arguments:
+        channels -- channel names; not needed when appending
+        metadata -- dict saved in the header, must be JSON serializable
+        dtypes -- dtype of each channel, default float64
+        compress -- compress chunks with zlib
+        append -- add to existing file at path instead of replacing it
+        """
+        self.path = path
+        self.compress = compress
+        self.buffer = []  # arrays of self.scan waiting to be written
+        self.buffered = 0
+        self.scan = None
+
+        if append and os.path.exists(path):
+            reader = Reader(path)
+            self.header = reader.header
+            self.metadata = reader.metadata
+            self.chunks = reader.chunks
+            self.file = open(path, 'r+b')
+            self.file.seek(reader.data_end)
+            self.file.truncate()  # old index
+        else:
+            if channels is None:
+                raise InputError(path, "Channels needed for new file.")
+            if dtypes is None:
+                dtypes = ['<f8']*len(channels)
+            self.header = dict(metadata or {})
+            self.header['channels'] = [[name, np.dtype(dtype).str]
+                                       for name, dtype in zip(channels,
+                                                              dtypes)]
+            self.header.setdefault('created', _timestamp())
+            self.metadata = {}
+            self.chunks = []  # [offset, scan, rows] of each DATA record
+            self.file = open(path, 'wb')
+            self.file.write(_FILE_HEADER.pack(MAGIC, VERSION))
+            self._record('HEAD', 0, json.dumps(self.header, default=str))
+        self.dtypes = [np.dtype(i[1]) for i in self.header['channels']]
+
+    def _record(self, kind, flags, payload):
+        offset = self.file.tell()
+        self.file.write(_RECORD.pack(kind, flags, len(payload)))
+        self.file.write(payload)
+        return offset
+
+    def append(self, scan, columns):
+        """Buffers samples of scan.
+
+        Arguments:
+        scan -- scan number
+        columns -- array with one row per channel (extra rows are ignored)
+        """
+        if scan != self.scan:
+            self.flush()
+            self.scan = scan
+        self.buffer.append(np.asarray(columns)[:len(self.dtypes)])
+        self.buffered += self.buffer[-1].shape[1]
+        if self.buffered >= self.chunk_rows:
+            self.flush()
+
+    def flush(self):
+        """Writes buffered samples as a chunk."""
+        if not self.buffered:
+            return
+        block = np.hstack(self.buffer)
+        payload = "".join(np.ascontiguousarray(row, dtype=dtype).tostring()
+                          for row, dtype in zip(block, self.dtypes))
+        flags = 0
+        if self.compress:
+            payload = zlib.compress(payload)
+            flags |= COMPRESSED
+        offset = self._record('DATA', flags,
+                              _CHUNK.pack(self.scan, self.buffered) + payload)
+        self.chunks.append([offset, self.scan, self.buffered])
+        self.buffer = []
+        self.buffered = 0
+        self.file.flush()
+
+    def close(self, metadata=None):
+        """Writes remaining samples and the index.
+
+        Keyword arguments:
+        metadata -- dict of entries to add to the header (e.g. end time)
+        """
+        self.flush()
+        self.metadata.update(metadata or {})
+        index = {'chunks': self.chunks, 'closed': _timestamp(),
+                 'metadata': self.metadata}
+        offset = self._record('INDX', 0, json.dumps(index, default=str))
+        self.file.write(_TRAILER.pack(offset, END_MAGIC))
+        self.file.close()
+
+class Reader(object):
+    """Reads a .dstat file with random access to scans.
+
+    Attributes:
+    header -- dict of header, updated with metadata given to close()
+    metadata -- metadata given to close()
+    channels -- channel names
+    scans -- number of scans (highest scan number + 1)
+    closed -- whether the file has an index
+
+    Public methods:
+    scan_length(self, scan)
+    read_scan(self, scan, channels=None)
+    read(self, channels=None)
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            magic, version = _FILE_HEADER.unpack(f.read(_FILE_HEADER.size))
+            if magic != MAGIC:
+                raise InputError(path, "Not a DStat data file.")
+            if version > VERSION:
+                raise InputError(path, "Unsupported version %i." % version)
+
+            kind, flags, length = _RECORD.unpack(f.read(_RECORD.size))
+            if kind != 'HEAD':
+                raise InputError(path, "Missing header.")
+            self.header = json.loads(f.read(length))
+            self.metadata = {}
+            self.closed = self._read_index(f)
+            if not self.closed:
+                self._scan_records(f)
+
+        self.channels = [i[0] for i in self.header['channels']]
+        self.dtypes = [np.dtype(i[1]) for i in self.header['channels']]
+        self.scans = max([i[1] for i in self.chunks] + [-1]) + 1
+
+    def _read_index(self, f):
+        """Reads index from end of file. Returns False if there is none."""
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        if size < _TRAILER.size:
+            return False
+        f.seek(size - _TRAILER.size)
+        offset, magic = _TRAILER.unpack(f.read(_TRAILER.size))
+        if magic != END_MAGIC:
+            return False
+        f.seek(offset)
+        kind, flags, length = _RECORD.unpack(f.read(_RECORD.size))
+        index = json.loads(f.read(length))
+        self.chunks = index['chunks']
+        self.metadata = index['metadata']
+        self.header.update(self.metadata)
+        self.header['closed'] = index['closed']
+        self.data_end = offset
+        return True
+
+    def _scan_records(self, f):
+        """Builds index by skipping through the records."""
+        self.chunks = []
+        f.seek(_FILE_HEADER.size)
+        self.data_end = f.tell()
+        while True:
+            offset = f.tell()
+            record = f.read(_RECORD.size)
+            if len(record) < _RECORD.size:
+                break
+            kind, flags, length = _RECORD.unpack(record)
+            if kind == 'DATA':
+                chunk = f.read(_CHUNK.size)
+                if len(chunk) < _CHUNK.size:
+                    break
+                scan, rows = _CHUNK.unpack(chunk)
+                f.seek(length - _CHUNK.size, os.SEEK_CUR)
+            else:
+                f.seek(length, os.SEEK_CUR)
+            if f.tell() > os.fstat(f.fileno()).st_size:
+                break  # truncated record
+            if kind == 'DATA':
+                self.chunks.append([offset, scan, rows])
+            self.data_end = f.tell()
+
+    def scan_length(self, scan):
+        """Returns number of samples in scan."""
+        return sum(i[2] for i in self.chunks if i[1] == scan)
+
+    def _read_chunk(self, f, offset, rows, indices):
+        """Returns list of arrays of channels given by indices."""
+        f.seek(offset)
+        kind, flags, length = _RECORD.unpack(f.read(_RECORD.size))
+        start = offset + _RECORD.size + _CHUNK.size
+        sizes = [rows*i.itemsize for i in self.dtypes]
+        if flags & COMPRESSED:
+            f.seek(start)
+            payload = zlib.decompress(f.read(length - _CHUNK.size))
+            return [np.frombuffer(payload, self.dtypes[i], rows,
+                                  sum(sizes[:i])) for i in indices]
+        columns = []
+        for i in indices:  # read only the wanted columns
+            f.seek(start + sum(sizes[:i]))
+            columns.append(np.frombuffer(f.read(sizes[i]), self.dtypes[i]))
+        return columns
+
+    def read_scan(self, scan, channels=None):
+        """Returns array with a row per channel of scan, reading only its
+        chunks.
+
+        Keyword arguments:
+        channels -- names of channels to read, default all
+        """
+        if channels is None:
+            channels = self.channels
+        indices = [self.channels.index(i) for i in channels]
+        blocks = []
+        with open(self.path, 'rb') as f:
+            for offset, chunk_scan, rows in self.chunks:
+                if chunk_scan == scan:
+                    blocks.append(self._read_chunk(f, offset, rows, indices))
+        if not blocks:
+            return np.empty((len(indices), 0))
+        return np.array([np.concatenate(i) for i in zip(*blocks)])
+
+    def read(self, channels=None):
+        """Returns list of arrays from read_scan() for all scans."""
+        return [self.read_scan(i, channels) for i in range(self.scans)]
+
+if __name__ == "__main__":
+    reader = Reader(sys.argv[1])
+    print "Channels: %s" % ", ".join(reader.channels)
+    for key in sorted(reader.header):
+        if key != 'channels':
+            print "%s: %s" % (key, reader.header[key])
+    print "%i scans, %i chunks, %s" % (reader.scans, len(reader.chunks),
+                                       "closed" if reader.closed
+                                       else "not closed")
+    for scan in range(reader.scans):
+        print "scan %i: %i samples" % (scan, reader.scan_length(scan))
@@ -0,0 +1,586 @@
+#!/usr/bin/env python
+#     DStat Interface - An interface for the open hardware DStat potentiostat
+#     Copyright (C) 2014  Michael D. M. Dryden -
+#     Wheeler Microfluidics Laboratory <http://microfluidics.utoronto.ca>
+#
+#
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Virtual DStat on a pseudo-terminal, for testing and benchmarking the
+acquisition path without hardware. POSIX only.
+
+The emulator speaks the same protocol as the firmware as far as dstat_comm
+uses it: each command is preceded by a '!' answered with 'C', arguments are
+space terminated and each command's output ends with 'no'. Experiments
+produce correctly framed 'B' samples calculated from a cell model, with 'S'
+after each scan. 'a' aborts a running experiment.
+
+    emu = VirtualDStat(model=RandlesSevcik(), noise=2)
+    emu.start()
+    dstat_comm.version_check(emu.port, pacing='none')
+    ...
+    emu.stop()
+
+Usage: python emulator.py [--fast] [--rate HZ] [--noise COUNTS] [--model M]
+"""
+
+import os, pty, tty, time, select, errno
+import multiprocessing as mp
+import numpy as np
+
+import stream_parser
+from errors import ErrorLogger
+_logger = ErrorLogger(sender="dstat-emulator")
+
+# Settings returned by SR, in EEPROM order
+DEFAULT_SETTINGS = [('max5443_offset', '0'), ('tcs_enabled', '1'),
+                    ('tcs_clear_threshold', '10000'), ('r100_trim', '0'),
+                    ('r3k_trim', '0'), ('r30k_trim', '0'),
+                    ('r300k_trim', '0'), ('r3M_trim', '0'),
+                    ('r30M_trim', '0'), ('r100M_trim', '0')]
+
+# Samples per second for ADC rate codes of the EA command (ADS1255 DRATE)
+ADC_RATES = {'03' : 2.5, '13' : 5, '23' : 10, '33' : 15, '43' : 25,
+             '53' : 30, '63' : 50, '72' : 60, '82' : 100, '92' : 500,
+             'A1' : 1000, 'B0' : 2000, 'C0' : 3750, 'D0' : 7500,
+             'E0' : 15000, 'F0' : 30000}
+
+# Gain resistors for each EG gain setting, as in dstat_comm.Experiment
+GAINS = {1 : [1e2, 3e2, 3e3, 3e4, 3e5, 3e6, 3e7, 5e8],
+         2 : [1, 1e2, 3e3, 3e4, 3e5, 3e6, 3e7, 1e8]}
+
+ADC_FULL_SCALE = 8388607  # 24 bit, +-1.5 V
+DAC_MV = 3000./65536  # mV per DAC step
+FARADAY = 96485.33
+GAS_CONSTANT = 8.314462
+
+_SAMPLE = np.dtype([('voltage', '<u2'), ('current', '<i4')])
+_TIMED_SAMPLE = np.dtype([('seconds', '<u2'), ('milliseconds', '<u2'),
+                          ('current', '<i4')])
+_PULSE_SAMPLE = np.dtype([('voltage', '<u2'), ('forward', '<i4'),
+                          ('reverse', '<i4')])
+
+BLOCK_SAMPLES = 4096  # samples calculated and written at a time
+
+class Abort(Exception):
+    """Raised when 'a' is received during an experiment."""
+    pass
+
+class CellModel(object):
+    """Electrochemical cell seen by the emulator. The default is a plain
+    resistor between working and reference/counter electrode. Potentials
+    are in mV and currents in A.
+    """
+    def __init__(self, resistance=1e6, ocp=0.):
+        """Keyword arguments:
+        resistance -- in ohms
+        ocp -- open circuit potential in mV
+        """
+        self.resistance = resistance
+        self.ocp = ocp
+
+    def sweep_current(self, potential, rate, direction):
+        """Returns array of currents during a potential sweep.
+
+        Arguments:
+        potential -- array of potentials
+        rate -- scan rate in mV/s
+        direction -- 1 if potential is increasing, -1 if decreasing
+        """
+        return (potential - self.ocp)/1000./self.resistance
+
+    def step_current(self, potential, elapsed):
+        """Returns array of currents after stepping to potential.
+
+        Arguments:
+        potential -- potential of step
+        elapsed -- array of seconds since the step
+        """
+        return np.ones(len(elapsed)) * (potential - self.ocp)/1000./ \
+                                                                self.resistance
+
+    def potential(self, elapsed):
+        """Returns array of open circuit potentials at elapsed seconds since
+        start of measurement.
+        """
+        return np.ones(len(elapsed)) * self.ocp
+
+class RandlesSevcik(CellModel):
+    """Reversible one-step redox couple at a planar electrode. Peak currents
+    follow the Randles-Sevcik equation and peaks are shifted 28.5/n mV from
+    the formal potential in the direction of the sweep. The wave shape is an
+    approximation, not a solution of the diffusion problem. A double layer
+    capacitance adds a charging current proportional to scan rate.
+    """
+    def __init__(self, e0=0., n=1, concentration=1e-6, area=0.07,
+                 diffusion=7e-6, capacitance=2e-6, temperature=298.15):
+        """Keyword arguments:
+        e0 -- formal potential in mV
+        n -- number of electrons transferred
+        concentration -- of both species in mol/cm^3
+        area -- of electrode in cm^2
+        diffusion -- diffusion coefficient in cm^2/s
+        capacitance -- double layer capacitance in F
+        temperature -- in K
+        """
+        super(RandlesSevcik, self).__init__(ocp=e0)
+        self.e0 = e0
+        self.n = n
+        self.concentration = concentration
+        self.area = area
+        self.diffusion = diffusion
+        self.capacitance = capacitance
+        self.f = n*FARADAY/(GAS_CONSTANT*temperature)/1000.  # per mV
+
+        # peak shape: rising sigmoid with a diffusion limited tail,
+        # normalized to 1 at the peak potential
+        self._xi = np.linspace(-30, 200, 4601)
+        shape = 1/(1 + np.exp(-self._xi)) / \
+                np.sqrt(1 + 0.5*np.log1p(np.exp(self._xi)))
+        peak = shape.argmax()
+        self._shape = shape/shape[peak]
+        self._xi -= self._xi[peak] - 28.5/n*self.f
+
+    def peak_current(self, rate):
+        """Returns Randles-Sevcik peak current in A at rate in mV/s."""
+        return (2.69e5 * self.n**1.5 * self.area * self.diffusion**.5 *
+                self.concentration * (abs(rate)/1000.)**.5)
+
+    def sweep_current(self, potential, rate, direction):
+        xi = direction*(np.asarray(potential, dtype=float) - self.e0)*self.f
+        faradaic = np.interp(xi, self._xi, self._shape, left=0.,
+                             right=self._shape[-1])
+        return direction*(self.peak_current(rate)*faradaic +
+                          self.capacitance*abs(rate)/1000.)
+
+    def step_current(self, potential, elapsed):
+        elapsed = np.maximum(elapsed, 1e-3)
+        cottrell = (self.n*FARADAY*self.area*self.concentration *
+                    np.sqrt(self.diffusion/(np.pi*elapsed)))
+        return cottrell*np.tanh((potential - self.e0)*self.f/2)
+
+MODELS = {'resistor' : CellModel, 'randles' : RandlesSevcik}
+
+class VirtualDStat(object):
+    """Emulated DStat attached to a pseudo-terminal. self.port can be
+    opened like the serial port of a real DStat.
+    """
+    def __init__(self, model=None, sample_rate=None, noise=0.,
+                 realtime=True, version=(1, 2), offset=0, light=12000,
+                 seed=None):
+        """Keyword arguments:
+        model -- CellModel instance (default 1 MOhm resistor)
+        sample_rate -- samples per second of time based experiments (CA,
+            PD, POT, OCP). Default is the rate set by the EA command.
+        noise -- RMS noise added to ADC readings, in counts
+        realtime -- if False, experiments are sent as fast as possible
+            instead of at the rate of the real instrument. Experiments
+            without a time limit are always sent in real time.
+        version -- (major, minor) reported by V
+        offset -- ADC offset in counts
+        light -- light sensor reading reported by T
+        seed -- for noise random number generator
+        """
+        if model is None:
+            model = CellModel()
+        self.model = model
+        self.sample_rate = sample_rate
+        self.noise = noise
+        self.realtime = realtime
+        self.version = version
+        self.offset = offset
+        self.light = light
+        self.seed = seed
+        self.settings = list(DEFAULT_SETTINGS)
+
+        self.adc_rate = ADC_RATES['92']
+        self.gain = GAINS[min(version[1], 2)][2]
+        self.process = None
+
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.slave)  # no echo or line editing
+        self.port = os.ttyname(self.slave)
+        self._input = bytearray()
+
+    def start(self):
+        """Starts serving in a child process."""
+        self.process = mp.Process(target=self.serve_forever)
+        self.process.daemon = True
+        self.process.start()
+        _logger.error("Virtual DStat on %s" % self.port, 'INFO')
+
+    def stop(self):
+        """Stops child process and closes the pseudo-terminal."""
+        if self.process is not None:
+            self.process.terminate()
+            self.process.join()
+            self.process = None
+        for fd in (self.master, self.slave):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+    def serve_forever(self):
+        """Answers commands until the process is terminated."""
+        self.random = np.random.RandomState(self.seed)
+        while True:
+            if self._getc() != '!':
+                continue  # ignore anything outside of a command
+            self._write("C\n")
+            try:
+                self._command()
+            except Abort:
+                _logger.error("Experiment aborted", 'INFO')
+                self._write("#INFO: Experiment aborted\nno\n")
+
+    def _command(self):
+        """Reads and executes one command after a handshake."""
+        letter = self._getc()
+        while letter == '!':  # repeated handshake
+            self._write("C\n")
+            letter = self._getc()
+
+        if letter == 'V':
+            self._write("V%i.%i\n" % self.version)
+        elif letter == 'T':
+            self._write("T%i\n" % self.light)
+        elif letter == 'S':
+            letter += self._getc()
+            if letter == 'SR':
+                self._write("".join(("S", ":".join(["%s.%s" % i for i in
+                                                     self.settings]), "\n")))
+            elif letter == 'SW':
+                for i in range(len(self.settings)):
+                    self.settings[i] = (self.settings[i][0],
+                                        self._token())
+        elif letter == 'E':
+            letter += self._getc()
+            handler = getattr(self, "_exp_" + letter[1], None)
+            if handler is None:
+                self._write("#ERR: Command %s not recognized\n" % letter)
+            else:
+                handler()
+        else:
+            self._write("#ERR: Command %s not recognized\n" % letter)
+
+        self._write("no\n")
+
+    # Serial input and output
+
+    def _getc(self):
+        """Returns next input character, blocking until there is one."""
+        while not self._input:
+            self._fill(None)
+        char = chr(self._input[0])
+        del self._input[0]
+        return char
+
+    def _token(self):
+        """Returns next space terminated argument."""
+        token = []
+        while True:
+            char = self._getc()
+            if char == ' ':
+                if token:
+                    return "".join(token)
+            else:
+                token.append(char)
+
+    def _ints(self, count):
+        return [int(self._token()) for i in range(count)]
+
+    def _fill(self, timeout):
+        """Reads available input, waiting up to timeout seconds (forever if
+        None) for it. Returns True if anything was read.
+        """
+        try:
+            ready = select.select([self.master], [], [], timeout)[0]
+        except select.error as err:
+            if err[0] != errno.EINTR:
+                raise
+            return False
+        if ready:
+            self._input.extend(os.read(self.master, 4096))
+            return True
+        return False
+
+    def _write(self, data):
+        view = buffer(data)
+        while view:
+            view = view[os.write(self.master, view):]
+
+    def _check_abort(self, timeout=0):
+        """Raises Abort if 'a' was received, waiting up to timeout
+        seconds for input.
+        """
+        if self._fill(timeout) or self._input:
+            if 'a' in self._input:
+                del self._input[:]
+                raise Abort()
+
+    def _wait(self, seconds):
+        """Waits (in real time mode), aborting if 'a' arrives."""
+        if not self.realtime or seconds <= 0:
+            return
+        end = time.time() + seconds
+        while time.time() < end:
+            self._check_abort(end - time.time())
+
+    def _send(self, samples, times, start):
+        """Writes samples as 'B' frames.
+
+        Arguments:
+        samples -- structured array of samples
+        times -- array of seconds after start each sample is due, or None to
+            send them immediately
+        start -- time.time() at start of experiment
+        """
+        frames = np.empty(len(samples),
+                          dtype=stream_parser.frame_dtype(samples.dtype))
+        frames['head'] = "B\n"
+        frames['tail'] = "\n"
+        for name in samples.dtype.names:
+            frames[name] = samples[name]
+        data = frames.tostring()
+        stride = frames.dtype.itemsize
+
+        if times is None:
+            self._check_abort()
+            self._write(data)
+            return
+
+        sent = 0
+        while sent < len(frames):
+            now = time.time() - start
+            due = int(np.searchsorted(times, now, side='right'))
+            if due > sent:
+                self._write(data[sent*stride:due*stride])
+                sent = due
+            if sent < len(frames):
+                self._check_abort(max(times[sent] - (time.time() - start),
+                                      .001))
+
+    # Conversions
+
+    def _adc_current(self, current):
+        counts = current*self.gain*ADC_FULL_SCALE/1.5 + self.offset
+        return self._adc(counts)
+
+    def _adc(self, counts):
+        if self.noise:
+            counts = counts + self.random.normal(0, self.noise, len(counts))
+        return np.clip(np.round(counts), -ADC_FULL_SCALE, ADC_FULL_SCALE)
+
+    def _rate(self):
+        if self.sample_rate:
+            return float(self.sample_rate)
+        return float(self.adc_rate)
+
+    def _pretreatment(self, clean_s, dep_s):
+        """Cleaning and deposition steps, which produce no samples."""
+        self._wait(clean_s + dep_s)
+
+    # Experiments
+
+    def _exp_A(self):
+        """ADC setup: buffer, rate, PGA"""
+        buf, rate, pga = [self._token() for i in range(3)]
+        self.adc_rate = ADC_RATES.get("%02X" % int(rate, 16), self.adc_rate)
+
+    def _exp_G(self):
+        """Gain setup: gain, RE short"""
+        gain, short = self._ints(2)
+        self.gain = GAINS[min(self.version[1], 2)][gain]
+
+    def _sweep(self, points, rate, start):
+        """Sends one linear sweep through points (mV) at rate (mV/s)."""
+        if len(points) == 0:
+            return
+        direction = 1 if points[-1] >= points[0] else -1
+        interval = DAC_MV/abs(rate) if rate else 0
+
+        for i in range(0, len(points), BLOCK_SAMPLES):
+            potential = points[i:i+BLOCK_SAMPLES]
+            samples = np.empty(len(potential), dtype=_SAMPLE)
+            samples['voltage'] = np.round(potential/DAC_MV + 32768)
+            samples['current'] = self._adc_current(
+                    self.model.sweep_current(potential, rate, direction))
+            times = None
+            if self.realtime:
+                times = (self.clock + interval *
+                         np.arange(1, len(potential) + 1))
+                self.clock = times[-1]
+            self._send(samples, times, start)
+
+    def _ramp(self, v1, v2):
+        """Returns potentials in mV between v1 and v2, in DAC steps."""
+        first = int(round(v1/DAC_MV))
+        last = int(round(v2/DAC_MV))
+        step = 1 if last >= first else -1
+        return np.arange(first, last + step, step)*DAC_MV
+
+    def _exp_L(self):
+        """Linear sweep voltammetry"""
+        clean_s, dep_s, clean, dep, v1, v2, slope = self._ints(7)
+        self._pretreatment(clean_s, dep_s)
+        start = time.time()
+        self.clock = 0.
+        self._sweep(self._ramp(v1, v2), slope, start)
+
+    def _exp_C(self):
+        """Cyclic voltammetry: start -> v1 -> v2 -> start for each scan"""
+        (clean_s, dep_s, clean, dep, v1, v2, first,
+         scans, slope) = self._ints(9)
+        self._pretreatment(clean_s, dep_s)
+        start = time.time()
+        self.clock = 0.
+        for scan in range(scans):
+            self._sweep(self._ramp(first, v1), slope, start)
+            self._sweep(self._ramp(v1, v2)[1:], slope, start)
+            self._sweep(self._ramp(v2, first)[1:], slope, start)
+            self._write("S\n")
+
+    def _pulses(self, points, pulse, interval, rate, start, base=False):
+        """Sends pulse voltammetry samples for points (mV) with pulse height
+        pulse (mV), one every interval seconds. If base is False, the
+        reverse current is measured at point-pulse (SWV), otherwise at
+        point (DPV).
+        """
+        direction = 1 if len(points) < 2 or points[-1] >= points[0] else -1
+        for i in range(0, len(points), BLOCK_SAMPLES):
+            potential = points[i:i+BLOCK_SAMPLES]
+            reverse = potential if base else potential - direction*pulse
+            samples = np.empty(len(potential), dtype=_PULSE_SAMPLE)
+            samples['voltage'] = np.round(potential/DAC_MV + 32768)
+            samples['forward'] = self._adc_current(self.model.sweep_current(
+                    potential + direction*pulse, rate, direction))
+            samples['reverse'] = self._adc_current(self.model.sweep_current(
+                    reverse, rate, -direction))
+            times = None
+            if self.realtime:
+                times = (self.clock + interval *
+                         np.arange(1, len(potential) + 1))
+                self.clock = times[-1]
+            self._send(samples, times, start)
+
+    def _steps(self, v1, v2, step):
+        step = abs(step) or 1
+        if v2 < v1:
+            step = -step
+        return np.arange(v1, v2 + step/2., step, dtype=float)
+
+    def _exp_S(self):
+        """Square wave voltammetry. Cyclic if scans > 0."""
+        (clean_s, dep_s, clean, dep, v1, v2, step, pulse,
+         freq, scans) = self._ints(10)
+        self._pretreatment(clean_s, dep_s)
+        start = time.time()
+        self.clock = 0.
+        interval = 1./freq if freq else 0
+        rate = abs(step)*freq
+        if scans < 1:
+            self._pulses(self._steps(v1, v2, step), pulse, interval, rate,
+                         start)
+            return
+        for scan in range(scans):
+            self._pulses(self._steps(v1, v2, step), pulse, interval, rate,
+                         start)
+            self._pulses(self._steps(v2, v1, step), pulse, interval, rate,
+                         start)
+            self._write("S\n")
+
+    def _exp_D(self):
+        """Differential pulse voltammetry"""
+        (clean_s, dep_s, clean, dep, v1, v2, step, pulse,
+         period, width) = self._ints(10)
+        self._pretreatment(clean_s, dep_s)
+        start = time.time()
+        self.clock = 0.
+        interval = period/1000.
+        rate = abs(step)/interval if interval else 0
+        self._pulses(self._steps(v1, v2, step), pulse, interval, rate, start,
+                     base=True)
+
+    def _timed(self, duration, start, func):
+        """Sends samples at self._rate() for duration seconds (forever if
+        duration is 0). func(elapsed) returns ADC counts for an array of
+        seconds since start.
+        """
+        rate = self._rate()
+        realtime = self.realtime or not duration
+        count = int(duration*rate) if duration else None
+        n = 0
+        while count is None or n < count:
+            block = BLOCK_SAMPLES
+            if count is not None:
+                block = min(block, count - n)
+            elif realtime:
+                block = max(int(rate*.1), 1)  # .1 s ahead
+            elapsed = self.clock + np.arange(1, block + 1)/rate
+            samples = np.empty(block, dtype=_TIMED_SAMPLE)
+            samples['seconds'] = elapsed.astype(int) % 65536
+            samples['milliseconds'] = (elapsed % 1)*1000
+            samples['current'] = func(elapsed)
+            self._send(samples, elapsed if realtime else None, start)
+            self.clock = elapsed[-1]
+            n += block
+
+    def _exp_R(self):
+        """Chronoamperometry / photodiode: potential steps"""
+        steps = self._ints(1)[0]
+        potentials = self._ints(steps)
+        durations = self._ints(steps)
+        interlock = self._ints(1)[0]
+        start = time.time()
+        self.clock = 0.
+        for dac, duration in zip(potentials, durations):
+            potential = (dac - 32768)*DAC_MV
+            begin = self.clock
+            self._timed(duration, start, lambda t: self._adc_current(
+                    self.model.step_current(potential, t - begin)))
+
+    def _exp_P(self):
+        """Potentiometry (mode 1) or OCP (mode 0). Time 0 runs until
+        aborted.
+        """
+        duration, mode = self._ints(2)
+        start = time.time()
+        self.clock = 0.
+        self._timed(duration, start, lambda t: self._adc(
+                self.model.potential(t)/1000.*ADC_FULL_SCALE/1.5))
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Virtual DStat")
+    parser.add_argument('--fast', action='store_true',
+                        help="send experiments as fast as possible")
+    parser.add_argument('--rate', type=float, default=None,
+                        help="samples/s of time based experiments")
+    parser.add_argument('--noise', type=float, default=0.,
+                        help="RMS noise in ADC counts")
+    parser.add_argument('--model', choices=sorted(MODELS.keys()),
+                        default='randles')
+    args = parser.parse_args()
+
+    emulator = VirtualDStat(model=MODELS[args.model](),
+                            sample_rate=args.rate, noise=args.noise,
+                            realtime=not args.fast)
+    print emulator.port
+    try:
+        emulator.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+#     DStat Interface - An interface for the open hardware DStat potentiostat
+#     Copyright (C) 2014  Michael D. M. Dryden -
+#     Wheeler Microfluidics Laboratory <http://microfluidics.utoronto.ca>
+#
+#
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Lazy table views of experiment data for the data tabs.
+
+DataModel presents the items of Experiment.data or data_extra as columns
+without copying them. Values are formatted only when the TreeView asks for
+them, which with fixed height mode is for the visible rows only.
+"""
+
+import gtk
+import gobject
+
+class DataModel(gtk.GenericTreeModel):
+    """Read-only list model with one column per item of data. Row
+    references are row numbers. Rows past the end of a shorter item are
+    blank.
+    """
+    def __init__(self, data):
+        """Arguments:
+        data -- sequence of 1D arrays, e.g. a storage.ScanView
+        """
+        gtk.GenericTreeModel.__init__(self)
+        self.columns = list(data)
+        self.rows = max([len(i) for i in self.columns] + [0])
+
+    def on_get_flags(self):
+        return gtk.TREE_MODEL_LIST_ONLY | gtk.TREE_MODEL_ITERS_PERSIST
+
+    def on_get_n_columns(self):
+        return len(self.columns)
+
+    def on_get_column_type(self, index):
+        return gobject.TYPE_STRING
+
+    def on_get_iter(self, path):
+        if path[0] < self.rows:
+            return path[0]
+        return None
+
+    def on_get_path(self, rowref):
+        return (rowref,)
+
+    def on_get_value(self, rowref, column):
+        values = self.columns[column]
+        if rowref < len(values):
+            return str(float(values[rowref]))
+        return ""
+
+    def on_iter_next(self, rowref):
+        if rowref + 1 < self.rows:
+            return rowref + 1
+        return None
+
+    def on_iter_children(self, parent):
+        if parent is None and self.rows:
+            return 0
+        return None
+
+    def on_iter_has_child(self, rowref):
+        return False
+
+    def on_iter_n_children(self, rowref):
+        if rowref is None:
+            return self.rows
+        return 0
+
+    def on_iter_nth_child(self, parent, n):
+        if parent is None and n < self.rows:
+            return n
+        return None
+
+    def on_iter_parent(self, child):
+        return None
+
+class DataView(object):
+    """Shows a DataModel in a gtk.TreeView.
+
+    Public methods:
+    set_data(self, data, titles=None)
+    clear(self)
+    """
+    column_width = 110
+
+    def __init__(self, treeview):
+        """Arguments:
+        treeview -- gtk.TreeView to use, normally from the glade file
+        """
+        self.treeview = treeview
+        self.cell = gtk.CellRendererText()
+        self.cell.set_property('xalign', 1.)
+        self.treeview.set_fixed_height_mode(True)  # only measure one row
+
+    def clear(self):
+        """Removes model and columns."""
+        self.treeview.set_model(None)
+        for column in self.treeview.get_columns():
+            self.treeview.remove_column(column)
+
+    def set_data(self, data, titles=None):
+        """Shows data. Takes constant time; nothing is formatted until
+        drawn.
+
+        Arguments:
+        data -- sequence of 1D arrays shown as columns
+
+        Keyword arguments:
+        titles -- column headers, default column numbers
+        """
+        self.clear()
+        model = DataModel(data)
+        if titles is None:
+            titles = [str(i) for i in range(model.on_get_n_columns())]
+        for n, title in enumerate(titles):
+            column = gtk.TreeViewColumn(title, self.cell, text=n)
+            column.set_sizing(gtk.TREE_VIEW_COLUMN_FIXED)
+            column.set_fixed_width(self.column_width)
+            column.set_resizable(True)
+            self.treeview.append_column(column)
+        self.treeview.set_model(model)
+
+def column_titles(view):
+    """Returns column headers for a storage.ScanView: channel name and scan
+    number for each item.
+    """
+    names = [view.store.channels[i] for i in view.rows]
+    return ["%s %i" % (names[n % len(names)], n // len(names))
+            for n in range(len(view))]
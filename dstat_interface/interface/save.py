@@ -18,12 +18,16 @@
 #     You should have received a copy of the GNU General Public License
 #     along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import gtk, io, os
+import gtk, gobject, io, os, time, copy, threading, Queue
 import numpy as np
 from datetime import datetime
+import render, dstat_file
+from errors import ErrorLogger
+_logger = ErrorLogger(sender="dstat-interface-save")
 
-def manSave(current_exp):
-    exp = current_exp
+def manSave(current_exp, worker=None):
+    """Asks for a path and saves current_exp there, on worker if given."""
+    exp = snapshot(current_exp)
     fcd = gtk.FileChooserDialog("Save...", None, gtk.FILE_CHOOSER_ACTION_SAVE,
                                 (gtk.STOCK_CANCEL, gtk.RESPONSE_CANCEL,
                                  gtk.STOCK_SAVE, gtk.RESPONSE_OK))
@@ -34,6 +38,12 @@ def manSave(current_exp):
     filters.append(gtk.FileFilter())
     filters[1].set_name("Space separated text (.txt)")
     filters[1].add_pattern("*.txt")
+    filters.append(gtk.FileFilter())
+    filters[2].set_name("DStat data (.dstat)")
+    filters[2].add_pattern("*.dstat")
+    filters.append(gtk.FileFilter())
+    filters[3].set_name("DStat data, compressed (.dstat)")
+    filters[3].add_pattern("*.dstat")
     
     fcd.set_do_overwrite_confirmation(True)
     for i in filters:
@@ -47,15 +57,26 @@ def manSave(current_exp):
         filter_selection = fcd.get_filter().get_name()
         
         if filter_selection.endswith("(.npy)"):
-            npy(exp, path)
+            run(worker, path, npy, exp, path)
         elif filter_selection.endswith("(.txt)"):
-            text(exp, path)
+            run(worker, path, text, exp, path)
+        elif filter_selection.endswith("(.dstat)"):
+            run(worker, path, dstat, exp, path, False,
+                filter_selection.startswith("DStat data, compressed"))
         fcd.destroy()
         
     elif response == gtk.RESPONSE_CANCEL:
         fcd.destroy()
 
-def plotSave(plot):
+def plotSave(plot, current_exp=None, worker=None):
+    """Asks for a path and saves plot there, on worker if given. Lines are
+    saved at full resolution from current_exp if given.
+    """
+    if current_exp is not None:
+        frame = plot.snapshot(plot.full_lines(current_exp))
+    else:
+        frame = plot.snapshot()
+    
     fcd = gtk.FileChooserDialog("Save Plot…", None,
                                 gtk.FILE_CHOOSER_ACTION_SAVE,
                                 (gtk.STOCK_CANCEL, gtk.RESPONSE_CANCEL,
@@ -87,50 +108,81 @@ def plotSave(plot):
             if not path.endswith(".png"):
                 path += ".png"
 
-        plot.figure.savefig(path)  # determines format from file extension
+        if worker is None:
+            plotFile(frame, path)
+        else:
+            worker.submit(path, plotFile, frame, path, worker.plot_process)
         fcd.destroy()
     
     elif response == gtk.RESPONSE_CANCEL:
         fcd.destroy()
 
-def autoSave(current_exp, dir_button, name, expnumber):
+def autoPath(dir_button, name, expnumber):
     if name == "":
         name = "file"
     path = dir_button.get_filename()
     path += '/'
     path += name
     path += str(expnumber)
+    return path
 
-    text(current_exp, path, auto=True)
+def autoStream(current_exp, dir_button, name, expnumber):
+    """Returns a TextStream autosaving current_exp as it runs."""
+    return TextStream(current_exp, autoPath(dir_button, name, expnumber))
 
-def autoPlot(plot, dir_button, name, expnumber):
-    if name == "":
-        name = "file"
-    
-    path = dir_button.get_filename()
-    path += '/'
-    path += name
-    path += str(expnumber)
+def autoMap(current_exp, dir_button, name, expnumber):
+    """Keeps current_exp's data in a .npy file at the autosave path while it
+    runs. Returns its storage.MappedStore, or None if current_exp doesn't
+    support it.
+    """
+    return current_exp.map_storage(unusedPath(
+                            autoPath(dir_button, name, expnumber), ".npy"))
+
+def autoPlot(frame, path, process=None):
+    """Saves plot snapshot frame as PDF at path, adding a number if the
+    file exists. See plotFile() for process.
+    """
+    plotFile(frame, unusedPath(path, ".pdf"), process)
+
+def plotFile(frame, path, process=None):
+    """Saves plot snapshot frame (from plot.plotbox.snapshot) to path in
+    the format given by its extension.
     
-    if path.endswith(".pdf"):
-        path = path.rstrip(".pdf")
+    Keyword arguments:
+    process -- render.PlotFileProcess to draw in instead of this thread;
+        needed on a SaveWorker (e.g. SaveWorker.plot_process), as
+        matplotlib isn't thread safe
+    """
+    if process is None:
+        render.plot_file(frame, path)
+    else:
+        process.save(frame, path)
 
-    j = 1
-    while os.path.exists("".join([path, ".pdf"])):
-        if j > 1:
-            path = path[:-len(str(j))]
-        path += str(j)
-        j += 1
+def snapshot(exp):
+    """Returns shallow copy of exp whose data doesn't change if exp is
+    still running, to be saved later.
+    """
+    exp = copy.copy(exp)
+    if hasattr(exp, 'store'):  # one snapshot for store, data and data_extra
+        exp.store = exp.store.snapshot()
+        exp.data = exp.store.view(exp.data.rows)
+        if exp.data_extra:
+            exp.data_extra = exp.store.view(exp.data_extra.rows)
+    return exp
 
-    path += ".pdf"
-    plot.figure.savefig(path)
+def run(worker, description, function, *args):
+    """Calls function with args on worker or, if None, now."""
+    if worker is None:
+        function(*args)
+    else:
+        worker.submit(description, function, *args)
 
 
 def npy(exp, path, auto=False):
     if path.endswith(".npy"):
         path = path.rstrip(".npy")
 
-    data = np.array(exp.data)
+    data = exp.data.array()  # no copy for single scan
 
     if auto == True:
         j = 1
@@ -142,35 +194,259 @@ def npy(exp, path, auto=False):
 
     np.save(path, data)
 
-def text(exp, path, auto=False):
-    if path.endswith(".txt"):
-        path = path.rstrip(".txt")
+def dstat(exp, path, auto=False, compress=False):
+    """Saves all channels of exp in dstat_file format with its parameters,
+    commands and gain in the header.
     
+    Keyword arguments:
+    auto -- add a number to path instead of overwriting
+    compress -- compress data chunks
+    """
     if auto == True:
-        j = 1
-        
-        while os.path.exists("".join([path, ".txt"])):
-            if j > 1:
-                path = path[:-len(str(j))]
-            path += str(j)
-            j += 1
+        path = unusedPath(path, ".dstat")
+    elif not path.endswith(".dstat"):
+        path += ".dstat"
     
-    path += ".txt"
-    file = open(path, 'w')
+    metadata = {'type': exp.__class__.__name__,
+                'commands': exp.commands}
+    for key in ('parameters', 'gain', 'gain_trim', 'xlabel', 'ylabel'):
+        if hasattr(exp, key):
+            metadata[key] = getattr(exp, key)
+    if 'version' in metadata.get('parameters', {}):
+        metadata['version'] = metadata['parameters']['version']
     
-    time = datetime.now()
+    store = exp.store
+    writer = dstat_file.Writer(path, store.channels, metadata,
+                               compress=compress)
+    for scan in range(store.scans):
+        writer.append(scan, store.array(scan=scan))
+    writer.close()
 
-    data = np.array(exp.data)
-    header = "".join(['#', time.isoformat(), "\n#"])
+def unusedPath(path, extension):
+    """Returns path with extension, adding a number if the file exists."""
+    if path.endswith(extension):
+        path = path[:-len(extension)]
+    
+    j = 1
+    while os.path.exists("".join([path, extension])):
+        if j > 1:
+            path = path[:-len(str(j))]
+        path += str(j)
+        j += 1
+    
+    return path + extension
+
+def textHeader(exp):
+    header = "".join(['#', datetime.now().isoformat(), "\n#"])
     for i in exp.commands:
         header += i
+    return "".join([header, '\n'])
 
-    file.write("".join([header, '\n']))
-    for col in zip(*exp.data):
-        for row in col:
-            file.write(str(row)+ "    ")
-        file.write('\n')
+def formatRows(columns, float_format="%s"):
+    """Returns text with a row for each index of columns (truncated to the
+    shortest) and each value followed by four spaces. All rows are
+    formatted by a single % operation.
+    
+    Arguments:
+    columns -- sequence of 1D arrays
+    
+    Keyword arguments:
+    float_format -- % format of a value; "%s" gives str() of each float
+    """
+    rows = min(len(i) for i in columns) if len(columns) else 0
+    if not rows:
+        return ""
+    line = "".join([float_format + "    "]*len(columns) + ["\n"])
+    values = np.column_stack([i[:rows] for i in columns]).ravel().tolist()
+    return (line*rows) % tuple(values)
+
+def writeColumns(file, columns, float_format="%s", chunk_rows=65536):
+    """Writes columns as formatRows() text in chunks of chunk_rows rows."""
+    rows = min(len(i) for i in columns) if len(columns) else 0
+    for start in range(0, rows, chunk_rows):
+        file.write(formatRows([i[start:start+chunk_rows] for i in columns],
+                              float_format))
+
+def text(exp, path, auto=False, float_format="%s"):
+    """Saves exp as text: header, then a column for each item of exp.data
+    followed by those of exp.data_extra (SWV/DPV forward and reverse).
+    
+    Keyword arguments:
+    auto -- add a number to path instead of overwriting
+    float_format -- % format of values, see formatRows()
+    """
+    if auto == True:
+        path = unusedPath(path, ".txt")
+    elif not path.endswith(".txt"):
+        path += ".txt"
+    
+    columns = list(exp.data)
+    if getattr(exp, 'data_extra', None):
+        columns += list(exp.data_extra)
     
-    file.close()
+    with open(path, 'w', 1 << 20) as file:
+        file.write(textHeader(exp))
+        writeColumns(file, columns, float_format)
 
+class TextStream(object):
+    """Writes an experiment to a text file while it runs. Samples are
+    buffered and appended in blocks of whole rows, so if the interface dies
+    the file holds everything up to the last block. The header is that of
+    text() plus a status line, which says "running" until close() replaces
+    it. Each scan after the first starts with a "#scan n" line.
+    
+    Public methods:
+    append(self, scan, columns)
+    flush(self)
+    close(self)
+    """
+    block_samples = 4096  # write when this many samples are buffered
+    block_time = 1.  # or when the oldest buffered sample is this old
+    status_width = 64  # bytes reserved for status line
+    
+    def __init__(self, exp, path, float_format="%s"):
+        """Creates file, adding a number to path if it exists.
+        
+        Arguments:
+        exp -- Experiment instance
+        path -- file path, ".txt" is added
+        
+        Keyword arguments:
+        float_format -- % format of values, see formatRows()
+        """
+        self.float_format = float_format
+        self.path = unusedPath(path, ".txt")
+        self.file = open(self.path, 'w')
+        self.file.write(textHeader(exp))
+        self.status_offset = self.file.tell()
+        self._status("running")
+        self.file.flush()
+        
+        self.blocks = []  # "#scan" lines and arrays waiting to be written
+        self.buffered = 0
+        self.samples = 0
+        self.scan = 0
+        self.since = None  # time oldest buffered block arrived
+        self.failed = False
+    
+    def _status(self, status):
+        line = "#status: " + status
+        self.file.write(line[:self.status_width-1].ljust(
+                            self.status_width-1) + "\n")
+    
+    def append(self, scan, columns):
+        """Buffers samples and writes them if enough have accumulated.
+        
+        Arguments:
+        scan -- scan number, not less than that of the last append
+        columns -- array with a row per channel, as sent by the
+            experiment; SWV/DPV forward and reverse are included
+        """
+        if self.failed:
+            return
+        if scan != self.scan:
+            self.blocks.append("#scan %i\n" % scan)
+            self.scan = scan
+        self.blocks.append(columns)
+        self.buffered += columns.shape[1]
+        if self.since is None:
+            self.since = time.time()
+        
+        if self.buffered >= self.block_samples or \
+                time.time() - self.since >= self.block_time:
+            self.flush()
+    
+    def flush(self):
+        """Writes buffered samples to disk."""
+        if self.failed or not self.blocks:
+            return
+        
+        lines = []
+        for block in self.blocks:
+            if isinstance(block, basestring):
+                lines.append(block)
+            else:
+                lines.append(formatRows(block, self.float_format))
+        try:
+            self.file.write("".join(lines))
+            self.file.flush()
+        except IOError as err:
+            _logger.error("Autosave to %s failed: %s" % (self.path, err),
+                          'WAR')
+            self.failed = True
+        
+        self.samples += self.buffered
+        self.blocks = []
+        self.buffered = 0
+        self.since = None
+    
+    def close(self):
+        """Writes remaining samples and finalises status line."""
+        self.flush()
+        if not self.failed:
+            try:
+                self.file.seek(self.status_offset)
+                self._status("complete, %i samples, %s" % (self.samples,
+                    datetime.now().replace(microsecond=0).isoformat()))
+                self.file.flush()
+                os.fsync(self.file.fileno())
+            except (IOError, OSError) as err:
+                _logger.error("Autosave to %s failed: %s" % (self.path, err),
+                              'WAR')
+        self.file.close()
 
+class SaveWorker(object):
+    """Runs save jobs in a background thread, one at a time in the order
+    submitted, so the GUI doesn't wait for files to be written. Progress
+    and errors are passed to a report function in the GTK main loop.
+    Plot files are drawn by self.plot_process (see plotFile()).
+    
+    Public methods:
+    submit(self, description, function, *args)
+    wait(self)
+    stop(self)
+    """
+    def __init__(self, report):
+        """Arguments:
+        report -- function called in GTK main loop with a message and the
+            number of jobs not yet finished
+        """
+        self.report = report
+        self.queue = Queue.Queue()
+        self.pending = 0  # only changed in main loop
+        self.plot_process = render.PlotFileProcess()  # before thread starts
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+    
+    def submit(self, description, function, *args):
+        """Queues function(*args). description names it in reports."""
+        self.pending += 1
+        self.queue.put((description, function, args))
+    
+    def wait(self):
+        """Blocks until all submitted jobs are finished."""
+        self.queue.join()
+    
+    def stop(self):
+        """Waits for all jobs, then ends self.plot_process."""
+        self.wait()
+        self.plot_process.stop()
+    
+    def _run(self):
+        while True:
+            description, function, args = self.queue.get()
+            gobject.idle_add(self._report, "Saving %s..." % description, 0)
+            try:
+                function(*args)
+                message = "Saved %s" % description
+            except Exception as err:
+                message = "Saving %s failed: %s" % (description, err)
+                _logger.error(message, 'WAR')
+            gobject.idle_add(self._report, message, 1)
+            self.queue.task_done()
+    
+    def _report(self, message, finished):
+        self.pending -= finished
+        self.report(message, self.pending)
+        return False
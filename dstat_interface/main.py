@@ -41,9 +41,11 @@ except ImportError:
     _logger.error('gobject not available', 'ERR')
     sys.exit(1)
 
+launch_dir = os.getcwd()  # for relative paths on command line
 os.chdir(os.path.dirname(os.path.abspath(sys.argv[0])))
 
 import interface.save as save
+import interface.data_view as data_view
 import dstat_comm as comm
 import interface.exp_window as exp_window
 import interface.adc_pot as adc_pot
@@ -54,9 +56,148 @@ from serial import SerialException
 import multiprocessing
 import time
 
+class IngestStats(object):
+    """Work done by Main.experiment_running_data per GTK wakeup."""
+    def __init__(self):
+        self.time = comm.TimingStats("wakeup")
+        self.messages = 0
+        self.samples = 0
+        self.max_messages = 0
+        self.max_samples = 0
+        self.over_budget = 0  # wakeups that stopped with data left
+    
+    def add(self, seconds, messages, samples, over_budget):
+        self.time.add(seconds)
+        self.messages += messages
+        self.samples += samples
+        self.max_messages = max(self.max_messages, messages)
+        self.max_samples = max(self.max_samples, samples)
+        if over_budget:
+            self.over_budget += 1
+    
+    def __str__(self):
+        wakeups = max(self.time.count, 1)
+        return ("%i wakeups, %.1f messages/%.0f samples per wakeup "
+                "(max %i/%i), %i over budget; %s" % (
+                self.time.count, float(self.messages)/wakeups,
+                float(self.samples)/wakeups, self.max_messages,
+                self.max_samples, self.over_budget, self.time))
+
+class RefreshScheduler(object):
+    """Calls a plot refresh function from the GTK main loop. Ticks where no
+    data arrived since the last refresh are skipped. The interval grows
+    when refreshing is expensive so it never takes more than load of the
+    main loop's time, and the timer runs at idle priority so input and data
+    are handled first.
+    
+    Public methods:
+    start(self)
+    stop(self)
+    data(self, samples)
+    """
+    max_interval = 2.  # seconds
+    load = .25  # fraction of time spent refreshing, at most
+    smoothing = .2  # weight of newest cost in running average
+    
+    def __init__(self, refresh, interval=.2):
+        """Arguments:
+        refresh -- function to call
+        
+        Keyword arguments:
+        interval -- shortest interval between refreshes in seconds
+        """
+        self.refresh = refresh
+        self.min_interval = interval
+        self.interval = interval
+        self.source = None
+        self.pending = False  # data arrived since last refresh
+        self.frames = 0
+        self.skipped = 0
+        self.samples = 0
+        self.cost = 0.  # running average of seconds per refresh
+        self.start_time = time.time()
+    
+    def start(self):
+        self.start_time = time.time()
+        self._schedule()
+    
+    def stop(self):
+        if self.source is not None:
+            gobject.source_remove(self.source)
+            self.source = None
+    
+    def data(self, samples):
+        """Notes that samples were added to the plotted data."""
+        self.pending = True
+        self.samples += samples
+    
+    def _schedule(self):
+        self.source = gobject.timeout_add(int(self.interval*1000), self._tick,
+                                    priority=gobject.PRIORITY_DEFAULT_IDLE)
+    
+    def _tick(self):
+        if not self.pending:
+            self.skipped += 1
+            return True
+        self.pending = False
+        
+        start = time.time()
+        self.refresh()
+        cost = time.time() - start
+        if self.frames:
+            self.cost += self.smoothing*(cost - self.cost)
+        else:
+            self.cost = cost
+        self.frames += 1
+        
+        interval = min(max(self.min_interval, self.cost/self.load),
+                       self.max_interval)
+        if abs(interval - self.interval) > .1*self.interval:
+            self.interval = interval
+            self._schedule()
+            return False  # replaced by new timer
+        return True
+    
+    def __str__(self):
+        elapsed = max(time.time() - self.start_time, 1e-3)
+        return ("%.1f fps, %i skipped, %.0f ms interval, %.0f samples/s" % (
+                self.frames/elapsed, self.skipped, self.interval*1000,
+                self.samples/elapsed))
+
 class Main(object):
     """Main program """
-    def __init__(self):
+    # Maximum seconds experiment_running_data spends receiving data before
+    # returning to the GTK main loop
+    ingest_budget = .02
+    
+    def __init__(self, capture=None, replay=None, replay_speed=1.,
+                 plot_worker=False, mapped_storage=False, pipelined=False,
+                 ring=False, pacing='legacy'):
+        """Keyword arguments:
+        capture -- path to record serial traffic to when connecting
+        replay -- path of capture to replay instead of connecting to the
+            selected port
+        replay_speed -- speed factor of replay or None for as fast as
+            possible
+        plot_worker -- render the plot in a separate process while an
+            experiment runs
+        mapped_storage -- when autosaving experiments that support it
+            (CA, PD, POT), keep data in a memory-mapped .npy file at the
+            autosave path instead of in memory and a text file
+        pipelined -- send experiment commands in one write where possible
+            (see dstat_comm.Experiment.validate_batch)
+        ring -- pass experiment data from the serial process through a
+            shared memory sample ring instead of the data pipe
+        pacing -- key of dstat_comm.PACING used for writes to the DStat
+        """
+        self.capture = capture
+        self.mapped_storage = mapped_storage
+        self.pipelined = pipelined
+        self.ring = ring
+        self.pacing = pacing
+        self.replay = replay
+        self.replay_speed = replay_speed
+        
         self.builder = gtk.Builder()
         self.builder.add_from_file('interface/dstatinterface.glade')
         self.builder.connect_signals(self)
@@ -67,14 +208,19 @@ class Main(object):
         self.ocp_disp = self.builder.get_object('ocp_disp')
         self.window = self.builder.get_object('window1')
         self.aboutdialog = self.builder.get_object('aboutdialog1')
-        self.rawbuffer = self.builder.get_object('databuffer1')
-        self.databuffer = self.builder.get_object('databuffer2')
+        self.commandlabel = self.builder.get_object('commandlabel')
+        self.rawview = data_view.DataView(
+                                self.builder.get_object('datatreeview1'))
+        self.extraview = data_view.DataView(
+                                self.builder.get_object('datatreeview2'))
         self.stopbutton = self.builder.get_object('pot_stop')
         self.startbutton = self.builder.get_object('pot_start')
         self.adc_pot = adc_pot.adc_pot()
         
         self.error_context_id = self.statusbar.get_context_id("error")
         self.message_context_id = self.statusbar.get_context_id("message")
+        self.plot_context_id = self.statusbar.get_context_id("plot")
+        self.save_context_id = self.statusbar.get_context_id("save")
         
         self.plotwindow = self.builder.get_object('plotbox')
         
@@ -85,7 +231,8 @@ class Main(object):
         self.autosavedir_button = self.builder.get_object('autosavedir_button')
         self.autosavename = self.builder.get_object('autosavename')
         
-        self.plot = plot.plotbox(self.plotwindow)
+        self.plot = plot.plotbox(self.plotwindow, fit_canvas=True,
+                                 worker=plot_worker)
         
         #fill adc_pot_box
         self.adc_pot_box = self.builder.get_object('gain_adc_box')
@@ -123,6 +270,10 @@ class Main(object):
         self.on_expcombobox_changed()
 
         self.expnumber = 0
+        self.current_exp = None
+        self.autosave_stream = None  # save.TextStream of running experiment
+        self.autosave_map = None  # storage.MappedStore of running experiment
+        self.save_worker = save.SaveWorker(self.on_save_report)
         
         self.connected = False
         
@@ -136,12 +287,23 @@ class Main(object):
     def on_window1_destroy(self, object, data=None):
         """ Quit when main window closed."""
         self.on_serial_disconnect_clicked()
+        self.plot.close()
+        self.save_worker.stop()
         gtk.main_quit()
 
     def on_gtk_quit_activate(self, menuitem, data=None):
         """Quit when Quit selected from menu."""
         self.on_serial_disconnect_clicked()
+        self.plot.close()
+        self.save_worker.stop()
         gtk.main_quit()
+    
+    def on_save_report(self, message, pending):
+        """Show progress of self.save_worker in statusbar."""
+        if pending:
+            message = "%s (%i queued)" % (message, pending)
+        self.statusbar.remove_all(self.save_context_id)
+        self.statusbar.push(self.save_context_id, message)
 
     def on_gtk_about_activate(self, menuitem, data=None):
         """Display the about window."""
@@ -170,8 +332,16 @@ class Main(object):
         
         try:
             self.serial_connect.set_sensitive(False)
-            self.version = comm.version_check(self.serial_liststore.get_value(
-                                    self.serial_combobox.get_active_iter(), 0))
+            if self.replay is None:
+                port = self.serial_liststore.get_value(
+                                    self.serial_combobox.get_active_iter(), 0)
+            else:
+                port = None
+            self.version = comm.version_check(port, pacing=self.pacing,
+                                              ring=self.ring,
+                                              capture=self.capture,
+                                              replay=self.replay,
+                                              replay_speed=self.replay_speed)
             
             self.statusbar.remove_all(self.error_context_id)
             
@@ -225,7 +395,7 @@ class Main(object):
         """Start OCP measurements."""
         if self.version[0] >= 1 and self.version[1] >= 2:
             _logger.error("Start OCP", "INFO")
-            comm.serial_instance.proc_pipe_p.send(comm.OCPExp())
+            comm.serial_instance.send_task(comm.OCPExp())
             self.ocp_proc = (gobject.io_add_watch(comm.serial_instance.data_pipe_p,
                                                  gobject.IO_IN,
                                                  self.ocp_running_data),
@@ -332,11 +502,32 @@ class Main(object):
             """ Starts experiment """
             self.plot.clearall()
             self.plot.changetype(self.current_exp)
+            self.plot.animate(True)  # blit lines while running
+            
+            if self.autosave_checkbox.get_active():
+                try:
+                    if self.mapped_storage:
+                        self.autosave_map = save.autoMap(self.current_exp,
+                                    self.autosavedir_button,
+                                    self.autosavename.get_text(),
+                                    self.expnumber)
+                    if self.autosave_map is None:
+                        self.autosave_stream = save.autoStream(
+                                    self.current_exp,
+                                    self.autosavedir_button,
+                                    self.autosavename.get_text(),
+                                    self.expnumber)
+                except (IOError, OSError) as err:
+                    _logger.error(err, 'WAR')
+                    self.statusbar.push(self.error_context_id,
+                                        "Autosave failed: %s" % err)
 
-            comm.serial_instance.proc_pipe_p.send(self.current_exp)
+            self.current_exp.pipelined = self.pipelined
+            comm.serial_instance.send_task(self.current_exp)
 
-            self.plot_proc = gobject.timeout_add(200,
+            self.plot_scheduler = RefreshScheduler(
                                                 self.experiment_running_plot)
+            self.plot_scheduler.start()
             self.experiment_proc = (
                     gobject.io_add_watch(comm.serial_instance.data_pipe_p,
                                             gobject.IO_IN,
@@ -351,6 +542,8 @@ class Main(object):
         
         while comm.serial_instance.data_pipe_p.poll(): # Clear data pipe
             comm.serial_instance.data_pipe_p.recv()
+        if comm.serial_instance.ring is not None:
+            comm.serial_instance.ring.clear()
         
         selection = self.expcombobox.get_active()
         parameters = {}
@@ -380,6 +573,7 @@ class Main(object):
         self.line = 0
         self.lastline = 0
         self.lastdataline = 0
+        self.ingest_stats = IngestStats()
         
         self.spinner.start()
         self.startbutton.set_sensitive(False)
@@ -397,11 +591,8 @@ class Main(object):
                 
                 self.current_exp = comm.Chronoamp(parameters)
                 
-                self.rawbuffer.set_text("")
-                self.rawbuffer.place_cursor(self.rawbuffer.get_start_iter())
-                
-                for i in self.current_exp.commands:
-                    self.rawbuffer.insert_at_cursor(i)
+                self.commandlabel.set_text(
+                                    "".join(self.current_exp.commands))
                    
                 run_experiment()
                 
@@ -659,42 +850,93 @@ class Main(object):
             exceptions()
 
     def experiment_running_data(self, source, condition):
-        """Receive data from experiment process and add to current_exp.data.
-        Run in GTK main loop.
+        """Receive all chunks of data waiting on data pipe, for up to
+        self.ingest_budget seconds, and add them to current_exp.data. Data is
+        read from comm.serial_instance.ring instead when a None message is
+        received. Run in GTK main loop.
         
         Returns:
         True -- when experiment is continuing to keep function in GTK's queue.
         False -- when experiment process signals EOFError or IOError to remove
             function from GTK's queue.
         """
+        start = time.time()
+        chunks = []
+        messages = 0
+        over_budget = False
+        
         try:
-            incoming = comm.serial_instance.data_pipe_p.recv()
-            if isinstance(incoming, basestring): # Test if incoming is str
-                self.experiment_done()
-                self.on_serial_disconnect_clicked()
-                return False
+            while True:
+                incoming = comm.serial_instance.data_pipe_p.recv()
+                if isinstance(incoming, basestring): # Test if incoming is str
+                    self.add_chunks(chunks)
+                    self.experiment_done()
+                    self.on_serial_disconnect_clicked()
+                    return False
+                
+                chunks += self.read_chunks(incoming)
+                messages += 1
+                
+                if not comm.serial_instance.data_pipe_p.poll():
+                    break
+                if time.time() - start >= self.ingest_budget:
+                    over_budget = True
+                    break
             
-            self.line, data = incoming
-            if self.line > self.lastdataline:
-                self.current_exp.data += [[], []]
-                if len(data) > 2:
-                    self.current_exp.data_extra += [[], []]
-                self.lastdataline = self.line
-            for i in range(2):
-                self.current_exp.data[2*self.line+i].append(data[i])
-                if len(data) > 2:
-                    self.current_exp.data_extra[2*self.line+i].append(
-                                                                    data[i+2])
+            samples = self.add_chunks(chunks)
+            if samples:
+                self.plot_scheduler.data(samples)
+            self.ingest_stats.add(time.time() - start, messages, samples,
+                                  over_budget)
+            _logger.error("experiment_running_data: %i messages, %i samples,"
+                          " %.2f ms%s" % (messages, samples,
+                                          self.ingest_stats.time.last*1000,
+                                          " (over budget)" if over_budget
+                                                           else ""), 'DBG')
             return True
 
         except EOFError as err:
             print err
+            self.add_chunks(chunks)
             self.experiment_done()
             return False
         except IOError as err:
             print err
+            self.add_chunks(chunks)
             self.experiment_done()
             return False
+    
+    def read_chunks(self, incoming):
+        """Returns list of (scan, array) tuples for a message received on
+        data pipe.
+        
+        Arguments:
+        incoming -- (scan, array) tuple or None to read all samples waiting
+            in comm.serial_instance.ring
+        """
+        if incoming is None:
+            return comm.serial_instance.ring.read_chunks()
+        return [incoming]
+    
+    def add_data(self, incoming):
+        """Add a message received on data pipe to current_exp.data.
+        Returns number of samples added.
+        """
+        return self.add_chunks(self.read_chunks(incoming))
+    
+    def add_chunks(self, chunks):
+        """Add list of (scan, array) tuples to current_exp.store, reserving
+        space for all of them at once. Returns number of samples added.
+        """
+        samples = sum(data.shape[1] for line, data in chunks)
+        self.current_exp.store.reserve(samples)
+        
+        for self.line, data in chunks:
+            self.current_exp.store.append(self.line, data)
+            self.lastdataline = max(self.lastdataline, self.line)
+            if self.autosave_stream is not None:
+                self.autosave_stream.append(self.line, data)
+        return samples
             
     def experiment_running_proc(self, source, condition):
         """Receive proc signals from experiment process.
@@ -731,16 +973,19 @@ class Main(object):
             
     def experiment_running_plot(self):
         """Plot all data in current_exp.data.
-        Run in GTK main loop. Always returns True so must be manually
-        removed from GTK's queue.
+        Run in GTK main loop by self.plot_scheduler. Always returns True.
         """
-        if self.line > self.lastline:
+        while self.line > self.lastline:
             self.plot.addline()
-            # make sure all of last line is added
-            self.plot.updateline(self.current_exp, self.lastline) 
-            self.lastline = self.line
+            # make sure all of last line is added, then leave it alone
+            self.plot.updateline(self.current_exp, self.lastline)
+            self.plot.freezeline(self.lastline)
+            self.lastline += 1
         self.plot.updateline(self.current_exp, self.line)
         self.plot.redraw()
+        self.statusbar.remove_all(self.plot_context_id)
+        self.statusbar.push(self.plot_context_id, "; ".join(
+                        (self.plot.frame_stats(), str(self.plot_scheduler))))
         return True
 
     def experiment_done(self):
@@ -748,36 +993,51 @@ class Main(object):
         copy data to raw data tab. Saves data if autosave enabled.
         """
         gobject.source_remove(self.experiment_proc[0])
-        gobject.source_remove(self.plot_proc)  # stop automatic plot update
+        self.plot_scheduler.stop()  # stop automatic plot update
+        
+        # add samples that arrived with or after the completion signal
+        try:
+            while comm.serial_instance.data_pipe_p.poll():
+                incoming = comm.serial_instance.data_pipe_p.recv()
+                if not isinstance(incoming, basestring):
+                    self.add_data(incoming)
+        except (EOFError, IOError) as err:
+            _logger.error(err, 'WAR')
+        if comm.serial_instance.ring is not None:
+            self.add_data(None)
+            _logger.error("".join(("Sample ring: ",
+                            str(comm.serial_instance.ring.stats()))), 'INFO')
+        _logger.error("".join(("Data ingestion: ", str(self.ingest_stats))),
+                      'INFO')
+        
         self.experiment_running_plot()  # make sure all data updated on plot
+        _logger.error("; ".join((self.plot.frame_stats(),
+                                 str(self.plot_scheduler))), 'INFO')
+        self.plot.animate(False)
+        self.plot.redraw()  # full draw with lines for saving and zooming
 
-        self.databuffer.set_text("")
-        self.databuffer.place_cursor(self.databuffer.get_start_iter())
-        self.rawbuffer.insert_at_cursor("\n")
-        self.rawbuffer.set_text("")
-        self.rawbuffer.place_cursor(self.rawbuffer.get_start_iter())
-
-        for i in self.current_exp.commands:
-            self.rawbuffer.insert_at_cursor(i)
-
-        self.rawbuffer.insert_at_cursor("\n")
-
-        for col in zip(*self.current_exp.data):
-            for row in col:
-                self.rawbuffer.insert_at_cursor(str(row)+ "    ")
-            self.rawbuffer.insert_at_cursor("\n")
-        
+        # data tabs format only the rows on screen
+        self.commandlabel.set_text("".join(self.current_exp.commands))
+        self.rawview.set_data(self.current_exp.data,
+                        data_view.column_titles(self.current_exp.data))
         if self.current_exp.data_extra:
-            for col in zip(*self.current_exp.data_extra):
-                for row in col:
-                    self.databuffer.insert_at_cursor(str(row)+ "    ")
-                self.databuffer.insert_at_cursor("\n")
+            self.extraview.set_data(self.current_exp.data_extra,
+                        data_view.column_titles(self.current_exp.data_extra))
+        else:
+            self.extraview.clear()
     
-        if self.autosave_checkbox.get_active():
-            save.autoSave(self.current_exp, self.autosavedir_button,
-                          self.autosavename.get_text(), self.expnumber)
-            save.autoPlot(self.plot, self.autosavedir_button,
-                          self.autosavename.get_text(), self.expnumber)
+        autosaved = [i for i in (self.autosave_stream, self.autosave_map)
+                     if i is not None]
+        self.autosave_stream = None
+        self.autosave_map = None
+        for i in autosaved:  # data written while running
+            self.save_worker.submit(i.path, i.close)
+        if autosaved:
+            path = save.autoPath(self.autosavedir_button,
+                                 self.autosavename.get_text(), self.expnumber)
+            self.save_worker.submit(path + ".pdf", save.autoPlot,
+                    self.plot.snapshot(self.plot.full_lines(self.current_exp)),
+                    path, self.save_worker.plot_process)
             self.expnumber += 1
         
         if self.dropbot_enabled == True:
@@ -805,11 +1065,14 @@ class Main(object):
     def on_file_save_exp_activate(self, menuitem, data=None):
         """Activate dialogue to save current experiment data. """
         if self.current_exp:
-            save.manSave(self.current_exp)
+            save.manSave(self.current_exp, self.save_worker)
     
     def on_file_save_plot_activate(self, menuitem, data=None):
         """Activate dialogue to save current plot."""
-        save.plotSave(self.plot)
+        if self.current_exp:
+            save.plotSave(self.plot, self.current_exp, self.save_worker)
+        else:
+            save.plotSave(self.plot, worker=self.save_worker)
     
     def on_menu_dropbot_connect_activate(self, menuitem, data=None):
         """Listen for remote control connection from µDrop."""
@@ -869,6 +1132,38 @@ class Main(object):
 
 if __name__ == "__main__":
     multiprocessing.freeze_support()
+    
+    import argparse
+    parser = argparse.ArgumentParser(description="DStat interface")
+    parser.add_argument('--capture', metavar='FILE',
+                        help="record serial traffic to FILE")
+    parser.add_argument('--replay', metavar='FILE',
+                        help="replay capture FILE instead of a serial port")
+    parser.add_argument('--replay-speed', type=float, default=1.,
+                        help="replay speed factor, 0 for as fast as possible")
+    parser.add_argument('--plot-worker', action='store_true',
+                        help="render plot in a separate process")
+    parser.add_argument('--mapped-storage', action='store_true',
+                        help="autosave CA, PD and POT data to a "
+                             "memory-mapped file as it is acquired")
+    parser.add_argument('--pipelined', action='store_true',
+                        help="send experiment commands in one write")
+    parser.add_argument('--ring', action='store_true',
+                        help="pass samples through shared memory ring")
+    parser.add_argument('--pacing', choices=sorted(comm.PACING),
+                        default='legacy',
+                        help="write pacing of commands (default legacy)")
+    args, unknown = parser.parse_known_args()
+    
+    for i in ('capture', 'replay'):
+        if getattr(args, i) is not None:
+            setattr(args, i, os.path.join(launch_dir, getattr(args, i)))
+    
     gobject.threads_init()
-    MAIN = Main()
+    MAIN = Main(capture=args.capture, replay=args.replay,
+                replay_speed=args.replay_speed or None,
+                plot_worker=args.plot_worker,
+                mapped_storage=args.mapped_storage,
+                pipelined=args.pipelined, ring=args.ring,
+                pacing=args.pacing)
     gtk.main()
\ No newline at end of file
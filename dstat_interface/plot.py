@@ -20,9 +20,16 @@
 """
 Creates data plot.
 """
+import time
 import gtk
+import gobject
 from matplotlib.figure import Figure
 
+import decimate
+import render
+from errors import ErrorLogger
+_logger = ErrorLogger(sender="dstat-plot")
+
 #from matplotlib.backends.backend_gtkcairo\
 #   import FigureCanvasGTKCairo as FigureCanvas
 #from matplotlib.backends.backend_gtkcairo\
@@ -34,12 +41,35 @@ from matplotlib.backends.backend_gtkagg \
 
 class plotbox(object):
     """Contains main data plot and associated methods."""
-    def __init__(self, plotwindow_instance):
+    max_points = 2000  # per line, unless fit_canvas
+    headroom = .1  # fraction of data range added when y-limits change
+    shrink = .5  # y-limits shrink when data spans less than this of them
+    
+    def __init__(self, plotwindow_instance, fit_canvas=False, blit=True,
+                 worker=False):
         """Creates plot and moves it to a gtk container.
         
         Arguments:
         plotwindow_instance -- gtk container to hold plot.
+        
+        Keyword arguments:
+        fit_canvas -- decimate lines to the pixel width of the axes instead
+                      of max_points.
+        blit -- allow animate() to draw lines over a cached background.
+        worker -- let animate() render in a render.RenderWorker process
+                  instead, so the main loop only paints finished images.
         """
+        self.fit_canvas = fit_canvas
+        self.blit = blit
+        self.use_worker = worker
+        self.worker = None
+        self.worker_watch = None  # gobject source of on_frame
+        self.animated = False
+        self.background = None  # axes without lines, while animated
+        self.limits = None  # view when background was cached
+        self.frozen_bounds = None  # y-range of frozen lines
+        self.sent = set()  # frozen lines already sent to worker
+        self.reset_stats()
         
         self.figure = Figure()
         self.figure.subplots_adjust(left=0.07, bottom=0.07,
@@ -47,6 +77,7 @@ class plotbox(object):
         self.axe1 = self.figure.add_subplot(111)
         
         self.lines = self.axe1.plot([0, 1], [0, 1])
+        self.decimators = [decimate.MinMaxDecimator()]
         
         self.axe1.ticklabel_format(style='sci', scilimits=(0, 3),
                                    useOffset=False, axis='y')
@@ -59,33 +90,87 @@ class plotbox(object):
         self.toolbar = NavigationToolbar(self.canvas, self.win)
         self.vbox.pack_start(self.toolbar, False, False)
         self.vbox.reparent(plotwindow_instance)
+        
+        self.canvas.mpl_connect('draw_event', self.on_draw)
     
     def clearall(self):
         """Remove all lines on plot. """
         for i in self.lines:
             i.remove()
         self.lines = self.axe1.plot([0, 1], [0, 1])
+        self.decimators = [decimate.MinMaxDecimator()]
+        self.lines[0].set_animated(self.animated)
+        self.frozen_bounds = None
+        self.sent = set()
+        self.reset_stats()
     
     def clearline(self, line_number):
         """Remove a line specified by line_number."""
         self.lines[line_number].remove()
         self.lines.pop(line_number)
+        self.decimators.pop(line_number)
     
     def addline(self):
         """Add a new line to plot. (initialized with dummy data)))"""
         self.lines.append(self.axe1.plot([0, 1], [0, 1])[0])
+        self.lines[-1].set_animated(self.animated)
+        self.decimators.append(decimate.MinMaxDecimator())
+    
+    def freezeline(self, line_number):
+        """Mark a finished line as final. Its plotted data is kept and no
+        longer updated. While animated it is drawn into the cached
+        background, so frames only draw lines that are still growing.
+        """
+        decimator = self.decimators[line_number]
+        if decimator is None:
+            return
+        if decimator.bounds is not None:
+            if self.frozen_bounds is None:
+                self.frozen_bounds = decimator.bounds
+            else:
+                self.frozen_bounds = (
+                    min(self.frozen_bounds[0], decimator.bounds[0]),
+                    max(self.frozen_bounds[1], decimator.bounds[1]))
+        self.decimators[line_number] = None
+        
+        line = self.lines[line_number]
+        if not line.get_animated():
+            return
+        line.set_animated(False)
+        if self.background is not None and self.view() == self.limits:
+            # add line to cached background instead of a full redraw
+            self.canvas.restore_region(self.background)
+            self.axe1.draw_artist(line)
+            self.background = self.canvas.copy_from_bbox(self.axe1.bbox)
+        else:
+            self.background = None
+    
+    def buckets(self):
+        """Returns maximum number of min/max buckets per line: enough for at
+        least one per pixel column of the axes if fit_canvas, else for
+        max_points points.
+        """
+        if self.fit_canvas:  # buckets merge pairwise, so up to half of this
+            return max(2*int(self.axe1.bbox.width), 1)
+        return self.max_points // 2
     
     def updateline(self, Experiment, line_number):
         """Update a line specified by line_number with data stored in
-        the Experiment instance.
+        the Experiment instance. Frozen lines are left as they are.
         """
-        # limits display to 2000 data points per line
-        divisor = len(Experiment.data[1+line_number*2]) // 2000 + 1
+        decimator = self.decimators[line_number]
+        if decimator is None:
+            return
+        
+        # first sample is skipped; only new samples are decimated
+        xdata = Experiment.data[line_number*2][1:]
+        ydata = Experiment.data[1+line_number*2][1:]
+        
+        decimator.set_buckets(self.buckets())
+        indices = decimator.update(ydata)
         
-        self.lines[line_number].set_ydata(
-                                   Experiment.data[1+line_number*2][1::divisor])
-        self.lines[line_number].set_xdata(
-                                   Experiment.data[line_number*2][1::divisor])
+        self.lines[line_number].set_ydata(ydata[indices])
+        self.lines[line_number].set_xdata(xdata[indices])
 
     def changetype(self, Experiment):
         """Change plot type. Set axis labels and x bounds to those stored
@@ -97,11 +182,194 @@ class plotbox(object):
 
         self.figure.canvas.draw()
 
-    def redraw(self):
-        """Autoscale and refresh the plot."""
-        self.axe1.relim()
-        self.axe1.autoscale(True, axis = 'y')
-        self.figure.canvas.draw()
+    def animate(self, enabled):
+        """Switches blitting or worker rendering on or off. While on, lines
+        are left out of full draws and redraw() only draws them over a
+        cached copy of the rest of the plot, or has the worker render a
+        snapshot. Switch off for a normal plot, e.g. before saving.
+        """
+        self.animated = enabled and (self.blit or self.use_worker)
+        for line, decimator in zip(self.lines, self.decimators):
+            line.set_animated(self.animated and decimator is not None)
+        self.background = None
+        
+        if self.animated and self.use_worker and self.worker is None:
+            self.worker = render.RenderWorker()
+            self.worker_watch = gobject.io_add_watch(self.worker.conn,
+                                                     gobject.IO_IN,
+                                                     self.on_frame)
+
+    def close(self):
+        """Stops the render worker, if one was started."""
+        if self.worker is None:
+            return
+        gobject.source_remove(self.worker_watch)
+        self.worker.stop()
+        self.worker = None
+        self.worker_watch = None
 
+    def on_draw(self, event):
+        """Caches the background after a full draw and adds the animated
+        lines, which the draw left out.
+        """
+        if not self.animated or self.use_worker:
+            return
+        self.background = self.canvas.copy_from_bbox(self.axe1.bbox)
+        self.limits = self.view()
+        self.draw_animated()
+
+    def draw_animated(self):
+        """Draws the lines left out of full draws."""
+        for i in self.lines:
+            if i.get_animated():
+                self.axe1.draw_artist(i)
+
+    def unsent_lines(self):
+        """Returns lines for a worker snapshot: every line except frozen
+        ones that were sent before.
+        """
+        lines = {}
+        for n, line in enumerate(self.lines):
+            if n in self.sent:
+                continue
+            lines[n] = (line.get_xdata(), line.get_ydata(), line.get_color())
+            if self.decimators[n] is None:
+                self.sent.add(n)
+        return lines
+
+    def full_lines(self, Experiment):
+        """Returns all lines with the undecimated data of Experiment."""
+        lines = {}
+        for n, line in enumerate(self.lines):
+            if 2*n + 1 < len(Experiment.data):
+                lines[n] = (Experiment.data[2*n][1:],
+                            Experiment.data[2*n+1][1:], line.get_color())
+            else:
+                lines[n] = (line.get_xdata(), line.get_ydata(),
+                            line.get_color())
+        return lines
+
+    def snapshot(self, lines=None):
+        """Returns what render.FrameRenderer needs to draw the plot as it
+        is now.
+        
+        Keyword arguments:
+        lines -- dict of line number: (xdata, ydata, color) to include,
+                 default all lines as plotted
+        """
+        if lines is None:
+            lines = dict((n, (i.get_xdata(), i.get_ydata(), i.get_color()))
+                         for n, i in enumerate(self.lines))
+        
+        pars = self.figure.subplotpars
+        return {'size': self.canvas.get_width_height(),
+                'dpi': self.figure.dpi,
+                'subplotpars': dict(left=pars.left, bottom=pars.bottom,
+                                    right=pars.right, top=pars.top),
+                'xlabel': self.axe1.get_xlabel(),
+                'ylabel': self.axe1.get_ylabel(),
+                'xlim': self.axe1.get_xlim(),
+                'ylim': self.axe1.get_ylim(),
+                'count': len(self.lines),
+                'lines': lines}
+
+    def on_frame(self, source, condition):
+        """Paints a frame finished by the worker. Run in GTK main loop."""
+        try:
+            width, height, pixels, seconds = self.worker.receive()
+        except (EOFError, IOError):
+            self.worker = None
+            self.worker_watch = None
+            self.use_worker = False  # fall back to drawing here
+            return False
+        self.render_time = seconds
+        
+        pixmap = getattr(self.canvas, '_pixmap', None)
+        if not self.animated or pixmap is None or \
+                (width, height) != self.canvas.get_width_height():
+            return True  # stale
+        pixbuf = gtk.gdk.pixbuf_new_from_data(pixels, gtk.gdk.COLORSPACE_RGB,
+                                              True, 8, width, height, width*4)
+        pixmap.draw_pixbuf(pixmap.new_gc(), pixbuf, 0, 0, 0, 0,
+                           width, height, gtk.gdk.RGB_DITHER_NONE, 0, 0)
+        self.canvas.window.draw_drawable(
+            self.canvas.style.fg_gc[self.canvas.state], pixmap,
+            0, 0, 0, 0, width, height)
+        return True
+
+    def view(self):
+        """Returns axis limits and position, which the cached background
+        depends on.
+        """
+        return (tuple(self.axe1.get_xlim()), tuple(self.axe1.get_ylim()),
+                tuple(self.axe1.bbox.bounds))
+
+    def reset_stats(self):
+        """Resets frame time statistics."""
+        self.frames = 0
+        self.full_frames = 0  # frames that redrew everything
+        self.frame_time = 0.  # seconds taken by last frame
+        self.total_time = 0.
+        self.render_time = 0.  # seconds worker took for last frame
+
+    def frame_stats(self):
+        """Returns frame time statistics as a string."""
+        mean = self.total_time/self.frames if self.frames else 0.
+        stats = "Plot: %.1f ms/frame (mean %.1f ms, %i of %i full)" % (
+            self.frame_time*1000, mean*1000, self.full_frames, self.frames)
+        if self.worker is not None:
+            stats += ", worker %.1f ms, %i dropped" % (
+                self.render_time*1000, self.worker.dropped)
+        return stats
+
+    def autoscale_y(self):
+        """Sets y-limits from the running bounds of the lines, which costs
+        the same however long they are. The limits only change when data
+        leaves them or fills less than shrink of them, and then get
+        headroom, so they don't jitter as data arrives.
+        """
+        bounds = [i.bounds for i in self.decimators
+                  if i is not None and i.bounds is not None]
+        if self.frozen_bounds is not None:
+            bounds.append(self.frozen_bounds)
+        if not bounds:
+            return
+        low = min(i[0] for i in bounds)
+        high = max(i[1] for i in bounds)
+        span = high - low
+        if span == 0:
+            span = abs(high) or 1.
+        
+        bottom, top = self.axe1.get_ylim()
+        if low < bottom or high > top or span < self.shrink*(top - bottom):
+            self.axe1.set_ylim(low - self.headroom*span,
+                               high + self.headroom*span)
+
+    def redraw(self):
+        """Autoscale and refresh the plot. When animated and the limits
+        haven't changed, only the lines are redrawn. With a worker, a
+        snapshot is sent to it instead.
+        """
+        start = time.time()
+        self.autoscale_y()
+        
+        if self.animated and self.use_worker:
+            try:
+                self.worker.submit(self.snapshot(self.unsent_lines()))
+            except IOError as err:
+                _logger.error(err, 'WAR')
+                self.use_worker = False
+        elif self.animated and self.background is not None and \
+                self.view() == self.limits:
+            self.canvas.restore_region(self.background)
+            self.draw_animated()
+            self.canvas.blit(self.axe1.bbox)
+        else:
+            self.figure.canvas.draw()
+            self.full_frames += 1
+        
+        self.frame_time = time.time() - start
+        self.total_time += self.frame_time
+        self.frames += 1
         return True
         
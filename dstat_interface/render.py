@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+#     DStat Interface - An interface for the open hardware DStat potentiostat
+#     Copyright (C) 2014  Michael D. M. Dryden -
+#     Wheeler Microfluidics Laboratory <http://microfluidics.utoronto.ca>
+#
+#
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Plot rendering in a separate process.
+
+The GUI sends snapshots of the plot (a dict made by plot.plotbox.snapshot)
+and gets back finished RGBA images to paint, so drawing never holds up the
+GTK main loop. PlotFileProcess saves snapshots to files for
+save.SaveWorker, as matplotlib isn't thread safe. Only Agg is used here;
+this module must not import gtk.
+"""
+
+import time
+import multiprocessing as mp
+
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+from errors import ErrorLogger
+_logger = ErrorLogger(sender="dstat-render")
+
+class FrameRenderer(object):
+    """Draws snapshots on an Agg canvas, reusing figure and lines between
+    frames.
+    """
+    def __init__(self):
+        self.figure = None
+        self.size = None
+        self.data = {}  # line number: (xdata, ydata, color)
+
+    def _setup(self, frame):
+        self.size = frame['size']
+        width, height = self.size
+        dpi = frame['dpi']
+        self.figure = Figure(figsize=(float(width)/dpi, float(height)/dpi),
+                             dpi=dpi)
+        self.canvas = FigureCanvasAgg(self.figure)
+        self.figure.subplots_adjust(**frame['subplotpars'])
+        self.axes = self.figure.add_subplot(111)
+        self.axes.ticklabel_format(style='sci', scilimits=(0, 3),
+                                   useOffset=False, axis='y')
+        self.lines = []
+
+    def update(self, frame):
+        """Sets up self.figure to show frame. Lines not in frame keep their
+        data from earlier frames.
+        """
+        changed = frame['lines'].keys()
+        if frame['size'] != self.size:
+            self._setup(frame)
+            changed = self.data.keys() + changed
+
+        count = frame['count']
+        for n in [i for i in self.data if i >= count]:
+            del self.data[n]
+        self.data.update(frame['lines'])
+        while len(self.lines) > count:
+            self.lines.pop().remove()
+        while len(self.lines) < count:
+            self.lines.extend(self.axes.plot([], []))
+        for n in changed:
+            if n < count:
+                xdata, ydata, color = self.data[n]
+                self.lines[n].set_data(xdata, ydata)
+                self.lines[n].set_color(color)
+
+        self.axes.set_xlabel(frame['xlabel'])
+        self.axes.set_ylabel(frame['ylabel'])
+        self.axes.set_xlim(frame['xlim'])
+        self.axes.set_ylim(frame['ylim'])
+
+    def render(self, frame):
+        """Returns (width, height, RGBA string) of frame."""
+        self.update(frame)
+        self.canvas.draw()
+        width, height = self.size
+        return width, height, str(self.canvas.buffer_rgba())
+
+def plot_file(frame, path):
+    """Saves snapshot frame to path in the format given by its extension,
+    on a new figure.
+    """
+    renderer = FrameRenderer()
+    renderer.update(frame)
+    renderer.figure.savefig(path)
+
+def _render_process(conn):
+    """Renders frames received on conn until None is received. Replies
+    with (width, height, pixels, seconds) for each frame.
+    """
+    renderer = FrameRenderer()
+    while True:
+        try:
+            frame = conn.recv()
+        except EOFError:
+            break
+        if frame is None:
+            break
+        start = time.time()
+        width, height, pixels = renderer.render(frame)
+        conn.send((width, height, pixels, time.time() - start))
+
+class RenderWorker(object):
+    """Process rendering plot snapshots. At most one frame is rendered at a
+    time; a frame submitted meanwhile waits and is replaced by any newer
+    one, so the worker never falls behind the GUI.
+
+    Public methods:
+    submit(self, frame)
+    receive(self)
+    fileno(self)
+    stop(self)
+    """
+    def __init__(self):
+        self.conn, child_conn = mp.Pipe()
+        self.proc = mp.Process(target=_render_process, args=(child_conn,))
+        self.proc.daemon = True
+        self.proc.start()
+        self.busy = False
+        self.pending = None  # frame waiting for worker
+        self.dropped = 0  # frames replaced before being rendered
+
+    def submit(self, frame):
+        """Queues frame for rendering."""
+        if self.busy:
+            if self.pending is not None:  # keep its line updates
+                self.dropped += 1
+                lines = self.pending['lines']
+                lines.update(frame['lines'])
+                frame['lines'] = lines
+            self.pending = frame
+            return
+        self.conn.send(frame)
+        self.busy = True
+
+    def receive(self):
+        """Returns (width, height, pixels, seconds) of rendered frame and
+        starts on the pending frame. Blocks until a frame is finished, so
+        call when fileno() is readable.
+        """
+        result = self.conn.recv()
+        self.busy = False
+        if self.pending is not None:
+            frame, self.pending = self.pending, None
+            self.submit(frame)
+        return result
+
+    def fileno(self):
+        return self.conn.fileno()
+
+    def stop(self):
+        """Ends the process, discarding a frame in progress."""
+        try:
+            if self.busy and self.conn.poll(1):
+                self.conn.recv()  # worker can't exit while sending
+            self.conn.send(None)
+        except (EOFError, IOError) as err:
+            _logger.error(err, 'WAR')
+        self.busy = False
+        self.pending = None
+        self.proc.join(1)
+
+def _plot_file_process(conn):
+    """Runs plot_file for (frame, path) tuples received on conn until None
+    is received. Replies with None or the exception raised for each.
+    """
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            break
+        if job is None:
+            break
+        try:
+            plot_file(*job)
+            conn.send(None)
+        except Exception as err:
+            conn.send(err)
+
+class PlotFileProcess(object):
+    """Process saving plot snapshots to files with plot_file. Start it from
+    the main thread; save() may then be called from one other thread.
+
+    Public methods:
+    save(self, frame, path)
+    stop(self)
+    """
+    def __init__(self):
+        self.conn, child_conn = mp.Pipe()
+        self.proc = mp.Process(target=_plot_file_process, args=(child_conn,))
+        self.proc.daemon = True
+        self.proc.start()
+
+    def save(self, frame, path):
+        """Saves frame to path, blocking until done. Raises the exception
+        the process got, or EOFError if it has died.
+        """
+        self.conn.send((frame, path))
+        error = self.conn.recv()
+        if error is not None:
+            raise error
+
+    def stop(self):
+        """Ends the process."""
+        try:
+            self.conn.send(None)
+        except IOError as err:
+            _logger.error(err, 'WAR')
+        self.proc.join(1)
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+#     DStat Interface - An interface for the open hardware DStat potentiostat
+#     Copyright (C) 2014  Michael D. M. Dryden -
+#     Wheeler Microfluidics Laboratory <http://microfluidics.utoronto.ca>
+#
+#
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Shared memory ring buffer for passing samples from the serial process to
+the GUI without pickling them through a pipe.
+"""
+
+import os, mmap
+import numpy as np
+
+# header fields (uint64)
+HEAD = 0  # total rows written, only changed by producer
+TAIL = 1  # total rows read, only changed by consumer
+DROPPED = 2  # rows discarded because the ring was full
+COLUMNS = 3  # data columns in use (excluding scan column)
+HIGH_WATER = 4  # maximum number of unread rows seen
+_HEADER = 5
+
+class SampleRing(object):
+    """Single producer, single consumer ring buffer of float64 rows in an
+    anonymous shared mmap. Each row is the scan number followed by up to
+    width-1 data columns.
+
+    The mapping is shared with child processes created by fork. On Windows
+    a named mapping is used so the ring can be pickled to a child process.
+    """
+    def __init__(self, capacity=2**18, width=5, tagname=None):
+        """Keyword arguments:
+        capacity -- number of rows
+        width -- columns per row, including scan number
+        tagname -- name of mapping (Windows only)
+        """
+        self.capacity = capacity
+        self.width = width
+        self.tagname = tagname
+
+        if os.name == 'nt' and self.tagname is None:
+            self.tagname = "dstat-ring-%i-%i" % (os.getpid(), id(self))
+
+        self._open()
+
+    def _open(self):
+        size = 8*(_HEADER + self.capacity*self.width)
+        if self.tagname is None:
+            self._mmap = mmap.mmap(-1, size)
+        else:
+            self._mmap = mmap.mmap(-1, size, tagname=self.tagname)
+
+        self.header = np.frombuffer(self._mmap, dtype=np.uint64,
+                                    count=_HEADER)
+        self.rows = np.frombuffer(self._mmap, dtype=np.float64,
+                                  offset=8*_HEADER).reshape(self.capacity,
+                                                            self.width)
+
+    def __getstate__(self):
+        if self.tagname is None:
+            raise TypeError("Anonymous SampleRing can only be shared by fork")
+        return (self.capacity, self.width, self.tagname)
+
+    def __setstate__(self, state):
+        self.capacity, self.width, self.tagname = state
+        self._open()
+
+    def write(self, scan, columns):
+        """Appends samples. Called by producer only. Samples that don't fit
+        are dropped and counted in the DROPPED header field.
+
+        Arguments:
+        scan -- scan number of samples
+        columns -- array with one row per data column
+
+        Returns number of samples written.
+        """
+        head = int(self.header[HEAD])
+        tail = int(self.header[TAIL])
+        count = columns.shape[1]
+        free = self.capacity - (head - tail)
+
+        if columns.shape[0] >= self.width:
+            raise ValueError("SampleRing too narrow for %i columns" %
+                             columns.shape[0])
+        if count > free:
+            self.header[DROPPED] = int(self.header[DROPPED]) + count - free
+            count = free
+        if count == 0:
+            return 0
+
+        self.header[COLUMNS] = columns.shape[0]
+        start = head % self.capacity
+        first = min(count, self.capacity - start)
+
+        self.rows[start:start+first, 0] = scan
+        self.rows[start:start+first, 1:columns.shape[0]+1] = \
+                                                        columns[:, :first].T
+        if first < count:
+            self.rows[:count-first, 0] = scan
+            self.rows[:count-first, 1:columns.shape[0]+1] = \
+                                                    columns[:, first:count].T
+
+        # publish rows only after they've been written
+        self.header[HEAD] = head + count
+        if head + count - tail > self.header[HIGH_WATER]:
+            self.header[HIGH_WATER] = head + count - tail
+        return count
+
+    def read(self):
+        """Returns copy of all unread rows as array with one row per sample
+        and frees them for the producer. Called by consumer only.
+        """
+        head = int(self.header[HEAD])
+        tail = int(self.header[TAIL])
+        count = head - tail
+        width = int(self.header[COLUMNS]) + 1
+
+        start = tail % self.capacity
+        first = min(count, self.capacity - start)
+        rows = self.rows[start:start+first, :width]
+        if first < count:
+            rows = np.vstack((rows, self.rows[:count-first, :width]))
+        else:
+            rows = rows.copy()
+
+        self.header[TAIL] = head
+        return rows
+
+    def read_chunks(self):
+        """Returns list of (scan, array) tuples of unread samples, as sent on
+        the data pipe by Experiment.flush_batch.
+        """
+        rows = self.read()
+        if not len(rows):
+            return []
+
+        # split wherever scan number changes
+        splits = np.flatnonzero(np.diff(rows[:, 0])) + 1
+        return [(int(i[0, 0]), i[:, 1:].T)
+                for i in np.split(rows, splits)]
+
+    def clear(self):
+        """Discards unread rows. Called by consumer only."""
+        self.header[TAIL] = self.header[HEAD]
+
+    def stats(self):
+        """Returns dict of counters."""
+        return {'written' : int(self.header[HEAD]),
+                'read' : int(self.header[TAIL]),
+                'dropped' : int(self.header[DROPPED]),
+                'high_water' : int(self.header[HIGH_WATER]),
+                'capacity' : self.capacity}
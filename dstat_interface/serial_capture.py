@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+#     DStat Interface - An interface for the open hardware DStat potentiostat
+#     Copyright (C) 2014  Michael D. M. Dryden -
+#     Wheeler Microfluidics Laboratory <http://microfluidics.utoronto.ca>
+#
+#
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Recording of raw serial traffic and replay of recordings in place of a
+serial port.
+
+A capture file starts with MAGIC followed by a header of format version and
+start time (seconds since the epoch). Then follow records of
+    <double seconds since start><uint8 direction><uint32 length><data>
+for each read from (RECEIVED) or write to (SENT) the DStat. Only bytes the
+interface actually read are recorded; input discarded by flushInput() never
+appears in a capture.
+
+Usage: python serial_capture.py capture_file  -- prints a summary
+"""
+
+import sys, time, struct
+import serial
+from errors import InputError, ErrorLogger
+_logger = ErrorLogger(sender="dstat-capture")
+
+MAGIC = "DSTATCAP"
+VERSION = 1
+RECEIVED = 0
+SENT = 1
+
+_HEADER = struct.Struct('<Hd')
+_RECORD = struct.Struct('<dBI')
+
+# reads within this many seconds of the first are stored as one record of
+# up to MERGE_MAX bytes, timestamped with the last read
+MERGE_WINDOW = .001
+MERGE_MAX = 65536
+
+class CaptureWriter(object):
+    """Writes a capture file. Each record is passed to the OS as soon as it
+    is complete, so a capture survives a crash of the interface.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.start = time.time()
+        self.file = open(path, 'wb')
+        self.file.write(MAGIC)
+        self.file.write(_HEADER.pack(VERSION, self.start))
+        self.pending = []  # data of RECEIVED record being merged
+        self.pending_size = 0
+        self.pending_start = 0  # time of first read in record
+        self.pending_time = 0  # time of last read in record
+
+    def record(self, direction, data):
+        """Adds data read (RECEIVED) or written (SENT) now."""
+        if not data:
+            return
+        now = time.time() - self.start
+        if direction == RECEIVED:
+            if self.pending and (now - self.pending_start > MERGE_WINDOW or
+                    self.pending_size + len(data) > MERGE_MAX):
+                self._flush()
+            if not self.pending:
+                self.pending_start = now
+            self.pending.append(data)
+            self.pending_size += len(data)
+            self.pending_time = now
+        else:
+            self._flush()
+            self._write(now, direction, data)
+
+    def _flush(self):
+        if self.pending:
+            self._write(self.pending_time, RECEIVED, "".join(self.pending))
+            self.pending = []
+            self.pending_size = 0
+
+    def _write(self, seconds, direction, data):
+        self.file.write(_RECORD.pack(seconds, direction, len(data)))
+        self.file.write(data)
+        self.file.flush()
+
+    def flush(self):
+        """Writes everything recorded so far, including a record still
+        being merged, to disk."""
+        self._flush()
+        self.file.flush()
+
+    def close(self):
+        self._flush()
+        self.file.close()
+
+def read_capture(path):
+    """Returns (start, records) of capture file at path. start is the time
+    the capture started, records a list of (seconds, direction, data)
+    tuples.
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise InputError(path, "Not a DStat capture file.")
+        version, start = _HEADER.unpack(f.read(_HEADER.size))
+        if version > VERSION:
+            raise InputError(path, "Unsupported capture version %i." %
+                             version)
+        records = []
+        while True:
+            header = f.read(_RECORD.size)
+            if len(header) < _RECORD.size:
+                break
+            seconds, direction, length = _RECORD.unpack(header)
+            data = f.read(length)
+            if len(data) < length:
+                _logger.error("%s: truncated record" % path, 'WAR')
+                break
+            records.append((seconds, direction, data))
+    return start, records
+
+class ReplaySerial(object):
+    """Stands in for a serial.Serial connected to the DStat by returning
+    the bytes of a capture. Received bytes are released in order, but never
+    before the write that preceded them in the capture has been repeated,
+    so a replay stays in step with the tasks sent to it. Those have to be
+    the same as during the capture: writes that aren't in the capture are
+    ignored, and received data that hasn't been read by the time of the
+    next matching write or flushInput() is skipped.
+
+    With speed set, data is released at the same delay after the preceding
+    write as in the capture, divided by speed. With speed None it is
+    released as soon as it is allowed.
+
+    read() raises serial.SerialException once all data has been read.
+    """
+    lookahead = 16  # writes searched for a match
+
+    def __init__(self, path, speed=1., timeout=1):
+        """Arguments:
+        path -- capture file
+
+        Keyword arguments:
+        speed -- replay speed factor or None for as fast as possible
+        timeout -- read timeout as for serial.Serial
+        """
+        self.path = path
+        self.speed = speed
+        self.timeout = timeout
+        start, self.records = read_capture(path)
+        self.writes = [n for n, i in enumerate(self.records)
+                       if i[1] == SENT]
+        received = [n for n, i in enumerate(self.records)
+                    if i[1] == RECEIVED]
+        self.last_received = received[-1] if received else -1
+        self.next_write = 0  # index in self.writes of next expected write
+        self.pos = 0  # index in self.records of next unreleased data
+        self.buffer = bytearray()
+        self.skipped = 0  # received bytes never read
+        self._set_gate()
+        self.anchor = (time.time(), 0.)  # (host time, capture time)
+
+    def _set_gate(self):
+        """Allows release of records up to next expected write."""
+        if self.next_write < len(self.writes):
+            self.gate = self.writes[self.next_write]
+        else:
+            self.gate = len(self.records)
+
+    def _due(self, seconds):
+        if not self.speed:
+            return 0
+        return self.anchor[0] + (seconds - self.anchor[1])/self.speed
+
+    def _release(self):
+        """Moves received data that is due to self.buffer. Returns time of
+        next release or None if waiting for a write.
+        """
+        now = time.time()
+        while self.pos < self.gate:
+            seconds, direction, data = self.records[self.pos]
+            if direction == RECEIVED:
+                due = self._due(seconds)
+                if due > now:
+                    return due
+                self.buffer.extend(data)
+            self.pos += 1
+        return None
+
+    def _finished(self):
+        return not self.buffer and self.pos > self.last_received
+
+    def inWaiting(self):
+        self._release()
+        return len(self.buffer)
+
+    def read(self, size=1):
+        deadline = None
+        if self.timeout is not None:
+            deadline = time.time() + self.timeout
+
+        while True:
+            due = self._release()
+            if len(self.buffer) >= size:
+                break
+            if self._finished():
+                raise serial.SerialException("End of capture %s" %
+                                             self.path)
+            now = time.time()
+            if deadline is not None and now >= deadline:
+                break
+            wait = .01 if due is None else due - now
+            if deadline is not None:
+                wait = min(wait, deadline - now)
+            if wait > 0:
+                time.sleep(wait)
+
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def readline(self):
+        line = []
+        while True:
+            char = self.read(1)
+            if not char:
+                break
+            line.append(char)
+            if char == '\n':
+                break
+        return "".join(line)
+
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if not line:
+                return
+            yield line
+
+    def write(self, data):
+        """Matches data with the next writes in capture and releases the
+        data received after it.
+        """
+        for n in range(self.next_write,
+                       min(self.next_write + self.lookahead,
+                           len(self.writes))):
+            index = self.writes[n]
+            if self.records[index][2] == data:
+                break
+        else:
+            _logger.error("replay: write %r not in capture" % data[:16],
+                          'DBG')
+            return
+
+        for seconds, direction, skipped in self.records[self.pos:index]:
+            if direction == RECEIVED:
+                self.skipped += len(skipped)
+        self.pos = max(self.pos, index + 1)
+        self.next_write = n + 1
+        self._set_gate()
+        self.anchor = (time.time(), self.records[index][0])
+
+    def flushInput(self):
+        """Discards released data that hasn't been read, which happens if
+        a task stops reading earlier than during the capture (e.g. an
+        aborted OCP measurement).
+        """
+        self.skipped += len(self.buffer)
+        del self.buffer[:]
+
+    def close(self):
+        if self.skipped:
+            _logger.error("replay: %i bytes skipped" % self.skipped, 'INFO')
+
+if __name__ == "__main__":
+    start, records = read_capture(sys.argv[1])
+    received = [i for i in records if i[1] == RECEIVED]
+    print "Captured %s" % time.strftime("%Y-%m-%d %H:%M:%S",
+                                        time.localtime(start))
+    print "%i records, %.1f s" % (len(records),
+                                  records[-1][0] if records else 0)
+    print "received: %i bytes in %i records" % (
+            sum(len(i[2]) for i in received), len(received))
+    print "sent: %i bytes in %i records" % (
+            sum(len(i[2]) for i in records if i[1] == SENT),
+            len(records) - len(received))
@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+#     DStat Interface - An interface for the open hardware DStat potentiostat
+#     Copyright (C) 2014  Michael D. M. Dryden -
+#     Wheeler Microfluidics Laboratory <http://microfluidics.utoronto.ca>
+#
+#
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Columnar storage for experiment data.
+
+Samples are kept in one float64 array with a row per channel, which grows
+by doubling. Scans are contiguous segments of it. Experiment.data and
+Experiment.data_extra are ScanView instances that index it like the lists
+of lists they used to be:
+    data[2*scan] -- x of scan
+    data[2*scan+1] -- y of scan
+Items are NumPy views, not copies.
+
+MappedStore keeps the array in a memory-mapped .npy file instead, for runs
+too long to hold in RAM.
+"""
+
+import time
+import numpy as np
+
+class DataStore(object):
+    """Growable columnar array of samples with named channels, divided into
+    scans.
+    """
+    min_capacity = 4096
+
+    def __init__(self, channels=('x', 'y')):
+        """Keyword arguments:
+        channels -- channel names, in order of the rows appended
+        """
+        self.channels = tuple(channels)
+        self.buffer = np.empty((len(self.channels), 0))
+        self.length = 0
+        self.starts = [0]  # index of first sample of each scan
+
+    def __len__(self):
+        return self.length
+
+    @property
+    def scans(self):
+        return len(self.starts)
+
+    def index(self, channel):
+        """Returns row of channel given by name or index."""
+        if isinstance(channel, basestring):
+            return self.channels.index(channel)
+        return channel
+
+    def reserve(self, count):
+        """Makes room for count more samples, at least doubling capacity if
+        the buffer has to grow.
+        """
+        needed = self.length + count
+        capacity = self.buffer.shape[1]
+        if needed <= capacity:
+            return
+        capacity = max(needed, 2*capacity, self.min_capacity)
+        buffer = np.empty((len(self.channels), capacity))
+        buffer[:, :self.length] = self.buffer[:, :self.length]
+        self.buffer = buffer
+
+    def new_scan(self):
+        """Starts a new, empty scan."""
+        self.starts.append(self.length)
+
+    def append(self, scan, columns):
+        """Appends samples to scan, starting new scans up to scan if
+        necessary.
+
+        Arguments:
+        scan -- scan number, not less than that of the last append
+        columns -- array with one row per channel (extra rows are ignored)
+        """
+        while scan >= self.scans:
+            self.new_scan()
+        count = columns.shape[1]
+        self.reserve(count)
+        rows = len(self.channels)
+        self.buffer[:, self.length:self.length+count] = columns[:rows]
+        self.length += count
+
+    def segment(self, scan):
+        """Returns (start, stop) indices of scan."""
+        if scan < 0:
+            scan += self.scans
+        if scan + 1 < self.scans:
+            return self.starts[scan], self.starts[scan+1]
+        return self.starts[scan], self.length
+
+    def column(self, channel, scan=None):
+        """Returns view of channel, for one scan or all samples."""
+        row = self.buffer[self.index(channel)]
+        if scan is None:
+            return row[:self.length]
+        start, stop = self.segment(scan)
+        return row[start:stop]
+
+    def array(self, channels=None, scan=None):
+        """Returns view of channels (default all) with one row per channel,
+        for one scan or all samples.
+        """
+        if scan is None:
+            start, stop = 0, self.length
+        else:
+            start, stop = self.segment(scan)
+        samples = self.buffer[:, start:stop]
+        if channels is None:
+            return samples
+        return samples[[self.index(i) for i in channels]]  # copy
+
+    def view(self, channels):
+        """Returns ScanView of channels."""
+        return ScanView(self, channels)
+
+    def snapshot(self):
+        """Returns read-only DataStore of the samples so far, sharing their
+        memory. Later appends don't change it: they only write past length
+        or move to a new buffer.
+        """
+        snapshot = DataStore(self.channels)
+        snapshot.buffer = self.buffer
+        snapshot.length = self.length
+        snapshot.starts = list(self.starts)
+        return snapshot
+
+class MappedStore(DataStore):
+    """DataStore in a memory-mapped file, so resident memory doesn't grow
+    with the length of an experiment. The file is a NumPy .npy file with a
+    row per channel, as np.load() returns it. Samples are stored in Fortran
+    order (all channels of a sample together), so growing only extends the
+    file and nothing is copied. The header is updated with the number of
+    samples every header_interval seconds while running, so the file can
+    be loaded at any time, and by close(), after which the file is the
+    finished result.
+
+    Scan boundaries aren't saved in the file, so only use for experiments
+    with a single scan.
+
+    Public methods:
+    close(self)
+    """
+    min_capacity = 65536
+    header_size = 128  # fixed, so data never moves when the header changes
+    header_interval = 1.
+
+    def __init__(self, path, channels=('x', 'y')):
+        """Creates file at path, replacing any existing file.
+
+        Arguments:
+        path -- file path, should end with ".npy"
+
+        Keyword arguments:
+        channels -- channel names, in order of the rows appended
+        """
+        super(MappedStore, self).__init__(channels)
+        self.path = path
+        self.file = open(path, 'w+b')
+        self.map = None
+        self.closed = False
+        self._write_header()
+
+    def __reduce__(self):
+        """The map can't be shared with other processes, so pickles (e.g.
+        when the experiment is sent to the serial process) as an empty
+        DataStore.
+        """
+        return DataStore, (self.channels,)
+
+    def _write_header(self):
+        header = "{'descr': '<f8', 'fortran_order': True, 'shape': (%i, %i), }"
+        header %= (len(self.channels), self.length)
+        prefix = np.lib.format.magic(1, 0)
+        length = self.header_size - len(prefix) - 2
+        self.file.seek(0)
+        self.file.write("".join((prefix, np.uint16(length).tostring(),
+                                 header.ljust(length - 1), "\n")))
+        self.file.flush()
+        self.header_time = time.time()
+
+    def reserve(self, count):
+        """Makes room for count more samples, at least doubling the file
+        size if it has to grow.
+        """
+        needed = self.length + count
+        capacity = self.buffer.shape[1]
+        if needed <= capacity:
+            return
+        capacity = max(needed, 2*capacity, self.min_capacity)
+        rows = len(self.channels)
+        self.file.truncate(self.header_size + capacity*rows*8)  # sparse
+        self.map = np.memmap(self.file, dtype='<f8', mode='r+',
+                             offset=self.header_size, shape=(capacity, rows))
+        self.buffer = self.map.T  # earlier maps stay valid for snapshots
+
+    def append(self, scan, columns):
+        super(MappedStore, self).append(scan, columns)
+        if time.time() - self.header_time > self.header_interval:
+            self._write_header()
+
+    def close(self):
+        """Writes remaining samples and the final header, trims the file
+        and leaves the store read-only.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        if self.map is not None:
+            self.map.flush()
+        self._write_header()
+        try:
+            self.file.truncate(self.header_size +
+                               self.length*len(self.channels)*8)
+        except IOError:  # Windows can't shrink a mapped file
+            pass
+        self.file.close()
+        if self.length:
+            self.buffer = np.load(self.path, mmap_mode='r')
+        self.map = None
+
+class ScanView(object):
+    """List-like view of a DataStore: item n*scan+i is channel i of scan,
+    where n is the number of channels in the view.
+    """
+    def __init__(self, store, channels):
+        self.store = store
+        self.rows = [store.index(i) for i in channels]
+
+    def __len__(self):
+        return len(self.rows)*self.store.scans
+
+    def __nonzero__(self):
+        return True  # like a list of empty lists
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return [self[i] for i in range(*item.indices(len(self)))]
+        if item < 0:
+            item += len(self)
+        if not 0 <= item < len(self):
+            raise IndexError("ScanView index out of range")
+        scan, channel = divmod(item, len(self.rows))
+        return self.store.column(self.rows[channel], scan)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __iadd__(self, other):
+        """data += [[], []] starts a new scan, as with the old lists."""
+        for i in range(len(other) // len(self.rows)):
+            self.store.new_scan()
+        return self
+
+    def array(self):
+        """Returns data as 2D array with a row per item, like
+        np.array(data) on the old lists. Only a single scan is returned
+        without copying. Scans of unequal length give an object array.
+        """
+        if self.store.scans == 1 and \
+                self.rows == range(self.rows[0], self.rows[-1] + 1):
+            return self.store.buffer[self.rows[0]:self.rows[-1]+1,
+                                     :self.store.length]
+        return np.array(list(self))
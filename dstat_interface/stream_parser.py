@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+#     DStat Interface - An interface for the open hardware DStat potentiostat
+#     Copyright (C) 2014  Michael D. M. Dryden -
+#     Wheeler Microfluidics Laboratory <http://microfluidics.utoronto.ca>
+#
+#
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Incremental parser for the DStat's serial output.
+
+The DStat sends newline terminated text lines with binary samples embedded:
+    B\\n<databytes of sample>\\n  -- one data point
+    S\\n                          -- end of scan
+    #...\\n                       -- info/error message
+    no\\n                         -- command finished
+Each command's output is preceded by a C acknowledging the '!' sent before
+the command. It is normally consumed by dstat_comm.handshake(), but appears
+in the stream when commands are pipelined.
+"""
+
+import numpy as np
+
+# event types yielded by FrameParser.events()
+BINARY = 'B'
+BLOCK = 'BB'
+SCAN = 'S'
+MESSAGE = '#'
+END = 'no'
+ACK = 'C'
+
+_NEWLINE = ord('\n')
+_B = ord('B')
+_S = ord('S')
+_C = ord('C')
+
+class FrameParser(object):
+    """Splits serial data into events without reading line by line. All
+    bytes available are read into one bytearray which is reused between
+    reads. Incomplete lines and frames are kept until the rest arrives.
+    """
+    def __init__(self, databytes, batch=False):
+        """Arguments:
+        databytes -- size of binary sample following a 'B' line
+        
+        Keyword arguments:
+        batch -- if True, consecutive samples are yielded together as BLOCK
+            events (see events())
+        """
+        self.databytes = databytes
+        self.batch = batch
+        self.stride = databytes + 3  # 'B\\n' + sample + '\\n'
+        self.buffer = bytearray()
+        self.pos = 0  # start of unparsed data in self.buffer
+
+    def read(self, ser):
+        """Appends all bytes waiting on ser to buffer. If none are waiting,
+        blocks for one byte up to ser's timeout. Returns number of bytes
+        read.
+        """
+        data = ser.read(max(ser.inWaiting(), 1))
+        self.feed(data)
+        return len(data)
+
+    def feed(self, data):
+        """Appends data to buffer, discarding already parsed bytes."""
+        if self.pos:
+            del self.buffer[:self.pos]
+            self.pos = 0
+        self.buffer.extend(data)
+
+    def clear(self):
+        """Discards all buffered data."""
+        del self.buffer[:]
+        self.pos = 0
+
+    def events(self):
+        """Generator yielding (event, payload) tuples for all complete
+        events in buffer:
+            (BINARY, str of databytes)
+            (BLOCK, str of consecutive 'B\\n<sample>\\n' frames)
+            (SCAN, None)
+            (MESSAGE, str of message line)
+            (END, str of terminating line)
+            (ACK, None)
+        BLOCK events are only produced in batch mode, for runs of samples
+        that are complete and correctly framed; see frame_dtype(). Other
+        samples are yielded as BINARY events.
+        
+        Stops after END, leaving any following data in buffer. Must be
+        exhausted (or abandoned) before the next call to read() or feed().
+        """
+        buf = self.buffer
+        databytes = self.databytes
+        end = len(buf)
+
+        while self.pos < end:
+            pos = self.pos
+            if buf[pos] == _C:  # not necessarily followed by newline
+                self.pos += 1
+                yield (ACK, None)
+                continue
+            
+            newline = buf.find('\n', pos)
+            if newline == -1:
+                return
+
+            first = buf[pos]
+            if first == _B:
+                if self.batch and newline == pos + 1:
+                    block = self._block(pos, end)
+                    if block:
+                        self.pos += len(block)
+                        yield (BLOCK, block)
+                        continue
+                if newline + 1 + databytes > end:
+                    return  # wait for rest of sample
+                self.pos = newline + 1 + databytes
+                yield (BINARY, bytes(buf[newline+1:self.pos]))
+                continue
+
+            self.pos = newline + 1
+
+            if first == _S:
+                yield (SCAN, None)
+                continue
+            elif first == _NEWLINE:
+                continue
+
+            line = bytes(buf[pos:newline]).strip()
+            if line.startswith('#'):
+                yield (MESSAGE, line)
+            elif line.startswith('no'):
+                yield (END, line)
+                return
+
+    def _block(self, pos, end):
+        """Returns str of all complete, correctly framed samples starting at
+        pos or None if there are less than two.
+        """
+        stride = self.stride
+        count = (end - pos) // stride
+        if count < 2:
+            return None
+
+        block = bytes(self.buffer[pos:pos+count*stride])
+        frames = np.frombuffer(block, dtype=np.uint8).reshape(count, stride)
+        valid = ((frames[:, 0] == _B) & (frames[:, 1] == _NEWLINE) &
+                 (frames[:, -1] == _NEWLINE))
+        if not valid.all():
+            count = int(valid.argmin())
+            if count < 2:
+                return None
+            block = block[:count*stride]
+        return block
+
+def frame_dtype(dtype):
+    """Returns structured dtype matching one 'B\\n<sample>\\n' frame of a
+    BLOCK event, given the dtype of the sample. Framing bytes are in the
+    'head' and 'tail' fields.
+    """
+    return np.dtype([('head', 'S2')] +
+                    [(name, dtype.fields[name][0]) for name in dtype.names] +
+                    [('tail', 'S1')])